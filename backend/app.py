@@ -1,14 +1,27 @@
-from flask import Flask, send_from_directory
+from flask import Flask, request
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from config import Config
-from models import db
+from json_provider import JSONProvider
+from models import db, CategoryStat, apply_sqlite_pragmas
 from routes import api
+from search import init_search_index
+from view_counter import view_counter
+from image_variants import image_variants
+from cache import response_cache
+from compression import compression
+from passwords import password_hasher
+from replicas import replica_router
+from file_utils import send_upload
+from storage import storage
 from waitress import serve
 import os
+import signal
 
 app = Flask(__name__)
 app.config.from_object(Config)
+# orjson when installed; datetimes are written in ISO 8601
+app.json = JSONProvider(app)
 
 # Configure CORS to allow frontend requests
 CORS(app, origins=[
@@ -19,17 +32,58 @@ CORS(app, origins=[
 ], supports_credentials=True)
 JWTManager(app)
 db.init_app(app)
+with app.app_context():
+    for engine in db.engines.values():
+        apply_sqlite_pragmas(engine, app.config.get('SQLITE_PRAGMAS'))
+compression.init_app(app)
+response_cache.init_app(app)
+replica_router.init_app(app)
+password_hasher.init_app(app)
+storage.init_app(app)
+view_counter.init_app(app)
+image_variants.init_app(app)
 
 app.register_blueprint(api, url_prefix='/api')
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # ?w=640 serves the closest resized variant of an image, WebP when accepted
+    width = request.args.get('w', type=int)
+    if width:
+        webp = 'image/webp' in request.headers.get('Accept', '')
+        variant = image_variants.resolve(filename, width, webp)
+        if variant:
+            response = send_upload(variant)
+            response.vary.add('Accept')
+            return response
+        # Variants may still be generating; don't let caches keep the original here
+        return send_upload(filename, immutable=False)
+    return send_upload(filename)
 
-if __name__ == '__main__':
+def init_database():
+    """Create missing tables and indexes before serving"""
     with app.app_context():
         db.create_all()
+        init_search_index()
+        if not CategoryStat.query.first():
+            CategoryStat.rebuild()
+            db.session.commit()
+
+def stop_server(signum, frame):
+    # Waitress finishes running requests on SystemExit; atexit hooks flush view counts
+    raise SystemExit(0)
+
+if __name__ == '__main__':
+    init_database()
     
-    print("Starting production server with Waitress on http://0.0.0.0:5000")
-    serve(app, host='0.0.0.0', port=5000)
+    host, port = app.config['SERVER_HOST'], app.config['SERVER_PORT']
+    signal.signal(signal.SIGTERM, stop_server)
+    print(f"Starting production server with Waitress on http://{host}:{port}")
+    serve(
+        app,
+        host=host,
+        port=port,
+        threads=app.config['SERVER_THREADS'],
+        connection_limit=app.config['SERVER_CONNECTION_LIMIT']
+    )
 
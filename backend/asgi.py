@@ -0,0 +1,36 @@
+"""
+ASGI entry point.
+
+Runs the app under uvicorn instead of Waitress:
+
+    python asgi.py
+    uvicorn asgi:application --workers 4 --timeout-graceful-shutdown 30
+
+uvicorn's event loop owns the sockets, so idle keep-alive connections and
+slow clients cost no thread; a2wsgi's bridge runs the Flask handlers on
+SERVER_THREADS threads per worker process. SERVER_WORKERS processes share
+the port. On SIGTERM uvicorn stops accepting and gives in-flight requests
+SERVER_SHUTDOWN_TIMEOUT seconds to finish.
+
+uvicorn and a2wsgi are in requirements.txt.
+"""
+
+from a2wsgi import WSGIMiddleware
+from app import app, init_database
+
+application = WSGIMiddleware(app, workers=app.config['SERVER_THREADS'])
+
+if __name__ == '__main__':
+    import uvicorn
+    
+    init_database()
+    
+    print(f"Starting ASGI server with uvicorn on http://{app.config['SERVER_HOST']}:{app.config['SERVER_PORT']}")
+    uvicorn.run(
+        'asgi:application',
+        host=app.config['SERVER_HOST'],
+        port=app.config['SERVER_PORT'],
+        workers=app.config['SERVER_WORKERS'],
+        timeout_graceful_shutdown=app.config['SERVER_SHUTDOWN_TIMEOUT'],
+        backlog=2048
+    )
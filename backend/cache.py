@@ -0,0 +1,209 @@
+"""
+Response cache for anonymous reads.
+
+Entries are keyed on a name (the endpoint and its arguments) plus the
+normalized query string, and carry tags such as ``posts`` or ``post:3``.
+Writes invalidate tags by bumping a version number that is folded into
+every key, which works the same for the in-process LRU store and for a
+shared Redis backend.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import g, request, make_response
+from compression import compression
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Response headers replayed from a cache entry
+CACHED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control')
+
+
+class MemoryBackend:
+    """In-process LRU store with per-entry expiry"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_versions(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+
+class RedisBackend:
+    """Store shared by every worker process and server"""
+
+    def __init__(self, url, prefix='blog:'):
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=timeout or None)
+
+    def get_versions(self, tags):
+        if not tags:
+            return []
+        values = self.client.mget([f'{self.prefix}tag:{tag}' for tag in tags])
+        return [int(value or 0) for value in values]
+
+    def bump(self, tags):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.incr(f'{self.prefix}tag:{tag}')
+        pipe.execute()
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self.backend = None
+        self.default_timeout = 60
+        self.replica_timeout = 10
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'memory')
+        self.default_timeout = app.config.get('CACHE_DEFAULT_TIMEOUT', self.default_timeout)
+        self.replica_timeout = app.config.get('REPLICA_STICKY_SECONDS', self.replica_timeout)
+
+        if cache_type == 'redis':
+            if redis is None:
+                raise RuntimeError("CACHE_TYPE 'redis' requires the redis package")
+            self.backend = RedisBackend(
+                app.config['CACHE_REDIS_URL'],
+                app.config.get('CACHE_KEY_PREFIX', 'blog:')
+            )
+        elif cache_type == 'memory':
+            self.backend = MemoryBackend(app.config.get('CACHE_MAX_ENTRIES', 1024))
+        else:
+            self.backend = None
+
+        app.extensions['response_cache'] = self
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def bypass(self):
+        """Authenticated requests and a disabled cache always go to the database"""
+        return not self.enabled or 'Authorization' in request.headers
+
+    def make_key(self, name, tags, args=()):
+        versions = self.backend.get_versions(tags)
+        parts = [name]
+        parts += [f'{tag}@{version}' for tag, version in zip(tags, versions)]
+        if args:
+            parts.append(urlencode(sorted(args)))
+        return '|'.join(parts)
+
+    def entry_timeout(self, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        if g.get('replica_engine') is not None:
+            # A lagging replica may have answered with data from before the
+            # last invalidation, so keep it no longer than the lag window
+            return min(timeout or self.replica_timeout, self.replica_timeout)
+        return timeout
+
+    def get_or_set(self, name, tags, loader, timeout=None):
+        """Return the cached value for ``name``, computing it with ``loader`` on a miss"""
+        if not self.enabled:
+            return loader()
+        key = self.make_key(name, tags)
+        value = self.backend.get(key)
+        if value is None:
+            value = loader()
+            self.backend.set(key, value, self.entry_timeout(timeout))
+        return value
+
+    def invalidate(self, *tags):
+        if self.enabled and tags:
+            self.backend.bump(tags)
+
+    def cached(self, *tags, timeout=None):
+        """
+        Cache successful anonymous responses of a view.
+
+        Tags may reference view arguments, e.g. ``'post:{id}'``.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                if self.bypass():
+                    return view(**kwargs)
+
+                entry_tags = [tag.format(**kwargs) for tag in tags]
+                name = ':'.join([request.endpoint] + [f'{k}={v}' for k, v in sorted(kwargs.items())])
+                key = self.make_key(name, entry_tags, list(request.args.items(multi=True)))
+
+                entry = self.backend.get(key)
+                if entry is not None:
+                    body, status, mimetype, headers = entry[:4]
+                    # Compressed copies of the body; entries from before compression have none
+                    encoded = entry[4] if len(entry) > 4 else {}
+                    response = make_response(body, status)
+                    response.mimetype = mimetype
+                    response.headers.extend(headers)
+                    compression.use_encoded(response, encoded)
+                    # Stored validators answer conditional requests without a query
+                    return response.make_conditional(request)
+
+                response = make_response(view(**kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    headers = [
+                        (name, value) for name, value in response.headers
+                        if name in CACHED_HEADERS
+                    ]
+                    body = response.get_data()
+                    # Compress once here rather than on every hit
+                    encoded = compression.compress_all(body, response.mimetype)
+                    self.backend.set(
+                        key,
+                        (body, response.status_code, response.mimetype, headers, encoded),
+                        self.entry_timeout(timeout)
+                    )
+                    compression.use_encoded(response, encoded)
+                return response
+            return wrapper
+        return decorator
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,106 @@
+"""
+Response compression.
+
+Responses whose type is listed in COMPRESS_MIN_SIZE, and whose body is at
+least that many bytes, are compressed with the best encoding the client
+accepts: brotli (when the brotli package is installed) or gzip. Uploads are
+left alone since media files are already compressed.
+
+Cached responses store their compressed bodies with the entry (see
+``cache.py``), so a cache hit is sent without compressing it again.
+"""
+
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compression:
+    def __init__(self, app=None):
+        self.min_sizes = {}
+        self.algorithms = ()
+        self.gzip_level = 6
+        self.brotli_quality = 4
+        self.exclude_paths = ()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.min_sizes = app.config.get('COMPRESS_MIN_SIZE', self.min_sizes)
+        self.algorithms = tuple(
+            name for name in app.config.get('COMPRESS_ALGORITHMS', ('br', 'gzip'))
+            if name != 'br' or brotli is not None
+        )
+        self.gzip_level = app.config.get('COMPRESS_GZIP_LEVEL', self.gzip_level)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', self.brotli_quality)
+        self.exclude_paths = tuple(app.config.get('COMPRESS_EXCLUDE_PATHS', self.exclude_paths))
+        app.after_request(self.compress_response)
+        app.extensions['compression'] = self
+
+    def compressible(self, mimetype, size=None):
+        """True when bodies of this type (and size, if given) are worth compressing"""
+        min_size = self.min_sizes.get(mimetype)
+        if min_size is None or not self.algorithms:
+            return False
+        return size is None or size >= min_size
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        # mtime=0 keeps the output identical for identical bodies
+        return gzip.compress(data, self.gzip_level, mtime=0)
+
+    def compress_all(self, data, mimetype):
+        """Compressed copies of a body in every configured encoding, or {} if it is not compressed"""
+        if not self.compressible(mimetype, len(data)):
+            return {}
+        return {encoding: self.compress(data, encoding) for encoding in self.algorithms}
+
+    def negotiate(self):
+        """The best encoding the client accepts, or None"""
+        return request.accept_encodings.best_match(self.algorithms)
+
+    def skip(self, response):
+        return (
+            response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or request.path.startswith(self.exclude_paths)
+            or not self.compressible(response.mimetype)
+        )
+
+    def apply(self, response, encoding, data):
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        # Another representation of the same content: only a weak match
+        etag, _ = response.get_etag()
+        if etag:
+            response.set_etag(etag, weak=True)
+
+    def use_encoded(self, response, encoded):
+        """Send one of a cached response's compressed bodies if the client accepts it"""
+        if self.skip(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding in encoded:
+            self.apply(response, encoding, encoded[encoding])
+        return response
+
+    def compress_response(self, response):
+        if self.skip(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        data = response.get_data()
+        if encoding is not None and self.compressible(response.mimetype, len(data)):
+            self.apply(response, encoding, self.compress(data, encoding))
+        return response
+
+
+compression = Compression()
@@ -0,0 +1,33 @@
+"""
+Conditional GET support.
+
+Single objects compute strong ETag and Last-Modified validators from a
+cheap query (timestamps); list views hash the rows they fetched. Either
+way a request whose validators still match gets a 304 before any
+serialization runs.
+"""
+
+import hashlib
+from flask import request, make_response
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """Strong ETag value from the parts that determine a response"""
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Let browsers and CDNs keep the body but revalidate before reusing it
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """A 304 response if the client's copy is still current, otherwise None"""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return set_validators(make_response('', 304), etag, last_modified)
@@ -1,45 +1,364 @@
 import os
-from flask import current_app
+import re
+import json
+import time
+import hashlib
+import mimetypes
+import threading
+from contextlib import contextmanager
+from flask import current_app, abort, redirect, send_from_directory
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 import uuid
+from models import db, Media, UPSERT_INSERTS
+from image_variants import remove_variants
+from storage import storage
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bytes read from a request or file per iteration when streaming
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Uploads named by their content hash, and their variants, never change
+CONTENT_NAME = re.compile(r'[0-9a-f]{64}(-\w+)?\.\w+')
 
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
+def upload_settings(upload_type):
+    """Allowed extensions and destination folder for an upload type"""
+    if upload_type == 'image':
+        return current_app.config['ALLOWED_IMAGE_EXTENSIONS'], current_app.config['UPLOADED_IMAGES_DEST']
+    elif upload_type == 'video':
+        return current_app.config['ALLOWED_VIDEO_EXTENSIONS'], current_app.config['UPLOADED_VIDEOS_DEST']
+    elif upload_type == 'avatar':
+        return current_app.config['ALLOWED_IMAGE_EXTENSIONS'], os.path.join(current_app.config['UPLOAD_FOLDER'], 'avatars')
+    return None, None
+
+def stored_path(upload_type, filename):
+    """Relative path for database storage"""
+    if upload_type == 'avatar':
+        return f"avatars/{filename}"
+    return f"{upload_type}s/{filename}"
+
+def hash_file(path):
+    """SHA-256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 def save_uploaded_file(file, upload_type='image'):
     if not file or file.filename == '':
         return None
     
-    if upload_type == 'image':
-        allowed_extensions = current_app.config['ALLOWED_IMAGE_EXTENSIONS']
-        upload_folder = current_app.config['UPLOADED_IMAGES_DEST']
-    elif upload_type == 'video':
-        allowed_extensions = current_app.config['ALLOWED_VIDEO_EXTENSIONS']
-        upload_folder = current_app.config['UPLOADED_VIDEOS_DEST']
-    elif upload_type == 'avatar':
-        allowed_extensions = current_app.config['ALLOWED_IMAGE_EXTENSIONS']
-        upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'avatars')
-    else:
+    allowed_extensions, upload_folder = upload_settings(upload_type)
+    if upload_folder is None:
         return None
     
     if not allowed_file(file.filename, allowed_extensions):
         return None
     
-    # Generate unique filename
     filename = secure_filename(file.filename)
     file_extension = filename.rsplit('.', 1)[1].lower()
-    unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
     
-    # Create upload directory if it doesn't exist
-    os.makedirs(upload_folder, exist_ok=True)
+    # Hash while writing to a temporary file; the content hash becomes the filename
+    os.makedirs(current_app.config['UPLOAD_TMP_DEST'], exist_ok=True)
+    temp_path = os.path.join(current_app.config['UPLOAD_TMP_DEST'], f"{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    with open(temp_path, 'wb') as out:
+        for block in iter(lambda: file.stream.read(STREAM_BLOCK_SIZE), b''):
+            digest.update(block)
+            out.write(block)
+            size += len(block)
     
-    # Save file
-    file_path = os.path.join(upload_folder, unique_filename)
-    file.save(file_path)
+    return add_media_file(temp_path, digest.hexdigest(), size, upload_type, file_extension)
+
+# Content-addressed media
+#
+# Uploads are stored as <sha256>.<ext>, so identical files share one copy in
+# storage. Each stored file has a Media row counting the posts and users that
+# reference it; the file and its resized variants are deleted once the last
+# reference is released and the releasing transaction commits.
+
+def add_media_file(temp_path, checksum, size, upload_type, file_extension):
+    """
+    Move a fully written local file to its content address in storage, or
+    drop it if that content is already stored, and count one new reference
+    to it. Returns the relative path for database storage.
+    """
+    path = stored_path(upload_type, f"{checksum}.{file_extension}")
     
-    # Return relative path for database storage
-    if upload_type == 'avatar':
-        return f"avatars/{unique_filename}"
+    if storage.exists(path):
+        # Duplicate upload: keep the stored copy
+        os.remove(temp_path)
     else:
-        return f"{upload_type}s/{unique_filename}"
\ No newline at end of file
+        storage.put(path, temp_path)
+    
+    return add_media_reference(path, checksum, size)
+
+def add_media_reference(path, checksum, size):
+    """Count one new reference to a stored file, registering it if needed"""
+    insert = UPSERT_INSERTS.get(db.engine.dialect.name)
+    if insert is not None:
+        # One statement, so concurrent uploads of the same content neither
+        # collide on the unique path nor lose an increment
+        db.session.execute(
+            insert(Media)
+            .values(path=path, sha256=checksum, size=size, ref_count=1)
+            .on_conflict_do_update(index_elements=[Media.path], set_={'ref_count': Media.ref_count + 1})
+        )
+        return path
+    
+    try:
+        with db.session.begin_nested():
+            media = Media.query.filter_by(path=path).first()
+            if media is None:
+                media = Media(path=path, sha256=checksum, size=size, ref_count=0)
+                db.session.add(media)
+            media.ref_count += 1
+    except IntegrityError:
+        # Another request registered the same file first
+        media = Media.query.filter_by(path=path).one()
+        media.ref_count += 1
+    return path
+
+def release_media(path):
+    """Drop one reference to a stored file; unused files are deleted after commit"""
+    if not path:
+        return
+    # Decrement in the database rather than on a loaded row, so an upload
+    # of the same content committing meanwhile isn't overwritten. Uploads
+    # from before content addressing have no row and are left alone.
+    media = Media.__table__
+    db.session.execute(
+        media.update().where(media.c.path == path).values(ref_count=media.c.ref_count - 1)
+    )
+    deleted = db.session.execute(media.delete().where(media.c.path == path, media.c.ref_count <= 0))
+    if deleted.rowcount:
+        unused = db.session.info.setdefault('unused_media', [])
+        unused.append(path)
+
+@db.event.listens_for(db.session, 'after_commit')
+def remove_unused_media(session):
+    unused = session.info.pop('unused_media', [])
+    if not unused:
+        return
+    media = Media.__table__
+    with db.engine.connect() as conn:
+        for path in unused:
+            # The same content may have been uploaded again meanwhile
+            if conn.execute(db.select(media.c.id).where(media.c.path == path)).first():
+                continue
+            storage.delete(path)
+            remove_variants(path)
+
+@db.event.listens_for(db.session, 'after_rollback')
+def keep_unused_media(session):
+    session.info.pop('unused_media', None)
+
+# Chunked uploads
+#
+# A chunked upload lives in UPLOAD_TMP_DEST as <id>.part (the bytes received
+# so far) and <id>.json (who started it and what it will become). Chunks are
+# appended straight from the request stream, so memory use stays bounded
+# however large the file is.
+
+def chunked_upload_paths(upload_id):
+    folder = current_app.config['UPLOAD_TMP_DEST']
+    return os.path.join(folder, f"{upload_id}.json"), os.path.join(folder, f"{upload_id}.part")
+
+def expire_chunked_uploads():
+    """Remove chunked uploads that were abandoned more than UPLOAD_EXPIRY seconds ago"""
+    folder = current_app.config['UPLOAD_TMP_DEST']
+    cutoff = time.time() - current_app.config['UPLOAD_EXPIRY']
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def start_chunked_upload(filename, upload_type, size, user_id):
+    """Register a new chunked upload; returns its metadata or None if it is not allowed"""
+    allowed_extensions, upload_folder = upload_settings(upload_type)
+    filename = secure_filename(filename or '')
+    if upload_folder is None or not allowed_file(filename, allowed_extensions):
+        return None
+    if not isinstance(size, int) or size <= 0 or size > current_app.config['MAX_UPLOAD_SIZE']:
+        return None
+    
+    expire_chunked_uploads()
+    os.makedirs(current_app.config['UPLOAD_TMP_DEST'], exist_ok=True)
+    
+    meta = {
+        'id': uuid.uuid4().hex,
+        'filename': filename,
+        'upload_type': upload_type,
+        'size': size,
+        'user_id': str(user_id)
+    }
+    meta_path, part_path = chunked_upload_paths(meta['id'])
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    
+    meta['offset'] = 0
+    return meta
+
+def load_chunked_upload(upload_id):
+    """Metadata of a chunked upload with its current offset, or None"""
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+        return None
+    meta_path, part_path = chunked_upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['offset'] = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return None
+    return meta
+
+class ChunkConflict(Exception):
+    """The chunk can't be appended at the offset it was sent for"""
+
+# Uploads being appended to, where flock is unavailable (Windows); that
+# only covers the current process
+_appending = set()
+_appending_lock = threading.Lock()
+
+@contextmanager
+def exclusive_append(upload_id, part):
+    """Hold the upload's append lock; ChunkConflict if another request has it"""
+    busy = ChunkConflict("Another chunk of this upload is still being written")
+    if fcntl is not None:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise busy from None
+        try:
+            yield
+        finally:
+            fcntl.flock(part, fcntl.LOCK_UN)
+        return
+    
+    with _appending_lock:
+        if upload_id in _appending:
+            raise busy
+        _appending.add(upload_id)
+    try:
+        yield
+    finally:
+        with _appending_lock:
+            _appending.discard(upload_id)
+
+def append_chunk(meta, stream, offset):
+    """
+    Append a request body to the upload at ``offset``, returning the new
+    offset. Raises ChunkConflict if the stored bytes don't end there, e.g.
+    for a retried chunk whose first attempt is still streaming.
+    """
+    _, part_path = chunked_upload_paths(meta['id'])
+    
+    with open(part_path, 'ab') as part, exclusive_append(meta['id'], part):
+        # Checked again under the lock: the upload may have grown since it was loaded
+        part.seek(0, os.SEEK_END)
+        if part.tell() != offset:
+            meta['offset'] = part.tell()
+            raise ChunkConflict("Offset mismatch")
+        while True:
+            block = stream.read(STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            if part.tell() + len(block) > meta['size']:
+                # Drop the partial chunk so the client can retry from offset
+                part.truncate(offset)
+                raise ValueError("Chunk exceeds the declared upload size")
+            part.write(block)
+        return part.tell()
+
+def finalize_chunked_upload(meta, checksum):
+    """
+    Verify a complete upload against its SHA-256 checksum and move it into
+    the media folder, counting one reference to the stored file. Returns the
+    relative path for database storage.
+    """
+    meta_path, part_path = chunked_upload_paths(meta['id'])
+    if meta['offset'] != meta['size']:
+        raise ValueError(f"Upload incomplete: {meta['offset']} of {meta['size']} bytes received")
+    
+    digest = hash_file(part_path)
+    if digest != (checksum or '').lower():
+        raise ValueError("Checksum mismatch")
+    
+    file_extension = meta['filename'].rsplit('.', 1)[1].lower()
+    path = add_media_file(part_path, digest, meta['size'], meta['upload_type'], file_extension)
+    os.remove(meta_path)
+    
+    return path
+
+# Direct uploads
+#
+# With an object store the client can upload straight to it: the file's
+# content address is fixed up front from its SHA-256, and the presigned
+# request only accepts that exact content.
+
+def direct_upload_path(filename, upload_type, checksum, size):
+    """Relative path a direct upload will be stored at, or None if it is not allowed"""
+    allowed_extensions, upload_folder = upload_settings(upload_type)
+    filename = secure_filename(filename or '')
+    if upload_folder is None or not allowed_file(filename, allowed_extensions):
+        return None
+    if not isinstance(size, int) or size <= 0 or size > current_app.config['MAX_UPLOAD_SIZE']:
+        return None
+    if not re.fullmatch(r'[0-9a-f]{64}', checksum or ''):
+        return None
+    file_extension = filename.rsplit('.', 1)[1].lower()
+    return stored_path(upload_type, f"{checksum}.{file_extension}")
+
+# Serving uploads
+
+def send_upload(path, immutable=None):
+    """
+    Response for a stored upload. Content-named files are marked immutable.
+    With MEDIA_ACCEL_REDIRECT_PREFIX set, only headers are returned and the
+    front web server sends the file; with USE_X_SENDFILE the same happens
+    through X-Sendfile. Otherwise the file is streamed with Range support.
+    Uploads kept in an object store are answered with a redirect to it.
+    """
+    url = storage.url(path)
+    if url is not None:
+        return redirect(url)
+    
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    if immutable is None:
+        immutable = CONTENT_NAME.fullmatch(os.path.basename(path)) is not None
+    
+    accel_prefix = current_app.config.get('MEDIA_ACCEL_REDIRECT_PREFIX')
+    if accel_prefix:
+        file_path = safe_join(upload_folder, path)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        )
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{path}"
+    else:
+        response = send_from_directory(upload_folder, path)
+    
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['MEDIA_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
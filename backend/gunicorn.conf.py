@@ -0,0 +1,65 @@
+"""
+Gunicorn settings: several worker processes sharing one preloaded app.
+
+    cd backend
+    gunicorn -c gunicorn.conf.py app:app
+
+The app and models are imported once in the master and the workers are
+forked from it, sharing that memory copy-on-write. Each worker gets its own
+database connections and password hashing pool, and is replaced after
+about SERVER_MAX_REQUESTS requests to bound memory growth. On SIGTERM,
+workers finish their requests for up to SERVER_SHUTDOWN_TIMEOUT seconds.
+
+SERVER_WORKERS defaults to one worker per CPU core. With more than one
+worker, set CACHE_TYPE=redis: each process would otherwise keep its own
+cache (and read-replica stickiness) and miss the others' writes.
+"""
+
+import os
+
+os.environ.setdefault('SERVER_WORKERS', str(os.cpu_count() or 1))
+
+from config import Config
+
+bind = f"{Config.SERVER_HOST}:{Config.SERVER_PORT}"
+workers = Config.SERVER_WORKERS
+worker_class = 'gthread'
+threads = Config.SERVER_THREADS
+worker_connections = Config.SERVER_CONNECTION_LIMIT
+preload_app = True
+max_requests = Config.SERVER_MAX_REQUESTS
+max_requests_jitter = Config.SERVER_MAX_REQUESTS // 10  # stagger restarts
+graceful_timeout = Config.SERVER_SHUTDOWN_TIMEOUT
+
+
+def on_starting(server):
+    from app import init_database
+    init_database()
+    if workers > 1 and Config.CACHE_TYPE == 'memory':
+        server.log.warning('CACHE_TYPE=memory with %d workers: writes only invalidate their own worker\'s cache', workers)
+
+
+def when_ready(server):
+    # Workers start their own pools; the master never hashes. Wait for the
+    # processes to exit so no worker is forked while they are still children
+    from passwords import password_hasher
+    password_hasher.stop(wait=True)
+
+
+def post_fork(server, worker):
+    from app import app
+    from models import db
+    from passwords import password_hasher
+    
+    # Connections opened in the master must not be shared; close=False leaves
+    # them to the master instead of closing its sockets
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    password_hasher.start()
+    # Forking a new pool from a threaded worker is unsafe: if a pool process
+    # dies, retire the worker and let the master fork a clean one
+    password_hasher.on_broken = lambda: setattr(worker, 'alive', False)
+    # view_counter and image_variants start their threads lazily, in the worker;
+    # view counts are flushed by their atexit hook when a worker exits
+
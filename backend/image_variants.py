@@ -0,0 +1,175 @@
+"""
+Background generation of resized image variants.
+
+After a post image is committed, ``image_variants.submit(path)`` queues a
+job on a small thread pool. The job writes a square thumbnail and one copy
+per ``IMAGE_VARIANT_WIDTHS`` entry narrower than the original, each in the
+original format and as WebP, to ``images/variants/`` in the upload storage. The result is stored
+in ``post.image_variants`` for every post using the image, and
+``/uploads/images/<name>?w=<width>`` serves the closest variant.
+"""
+
+import os
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from models import db, Post
+from cache import response_cache
+from storage import storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+VARIANT_FOLDER = 'variants'
+
+# Pillow format for the original-format copy; other images (GIF) are left as is
+SAVE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+
+def variant_path(path, label, extension):
+    """Relative path of a variant, e.g. images/variants/<name>-640.webp"""
+    folder, filename = path.rsplit('/', 1)
+    stem = filename.rsplit('.', 1)[0]
+    return f"{folder}/{VARIANT_FOLDER}/{stem}-{label}.{extension}"
+
+
+def remove_variants(path):
+    """Delete every variant generated for an image"""
+    folder, filename = path.rsplit('/', 1)
+    storage.delete_prefix(f"{folder}/{VARIANT_FOLDER}/{filename.rsplit('.', 1)[0]}-")
+
+
+def save_image(image, path, image_format, quality):
+    """Encode an image to a temporary file and move it into storage"""
+    temp_folder = current_app.config['UPLOAD_TMP_DEST']
+    os.makedirs(temp_folder, exist_ok=True)
+    temp_path = os.path.join(temp_folder, f"{uuid.uuid4().hex}.tmp")
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    try:
+        image.save(temp_path, format=image_format, quality=quality, optimize=True)
+        storage.put(path, temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def generate_variants(path, widths, thumbnail_size, quality=80):
+    """
+    Write the variants of an image that are missing and return the
+    ``image_variants`` value describing them, or None if the image is not
+    resized (Pillow missing or an unsupported format). Needs an app context.
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    if Image is None or extension not in SAVE_FORMATS:
+        return None
+
+    with storage.open_local(path) as local_path, Image.open(local_path) as source:
+        # Apply camera rotation before resizing; the EXIF tag is not copied
+        original = ImageOps.exif_transpose(source)
+        original.load()
+
+    def write(label, make):
+        variant = {'url': variant_path(path, label, extension), 'webp': variant_path(path, label, 'webp')}
+        targets = [(variant['url'], SAVE_FORMATS[extension]), (variant['webp'], 'WEBP')]
+        image = None
+        for target, image_format in targets:
+            # Content-addressed names mean an existing variant is already correct
+            if not storage.exists(target):
+                image = image or make()
+                save_image(image, target, image_format, quality)
+        return variant
+
+    thumbnail = write('thumb', lambda: ImageOps.fit(original, (thumbnail_size, thumbnail_size), Image.LANCZOS))
+    thumbnail['width'] = thumbnail_size
+
+    sizes = []
+    for width in sorted(widths):
+        if width >= original.width:
+            break
+        height = round(original.height * width / original.width)
+        variant = write(str(width), lambda: original.resize((width, height), Image.LANCZOS))
+        variant['width'] = width
+        sizes.append(variant)
+
+    return {
+        'width': original.width,
+        'height': original.height,
+        'thumbnail': thumbnail,
+        'sizes': sizes
+    }
+
+
+class ImageVariants:
+    def __init__(self, app=None):
+        self.app = None
+        self.widths = (320, 640, 1280)
+        self.thumbnail_size = 200
+        self.quality = 80
+        self.workers = 2
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.widths = tuple(sorted(app.config.get('IMAGE_VARIANT_WIDTHS', self.widths)))
+        self.thumbnail_size = app.config.get('IMAGE_THUMBNAIL_SIZE', self.thumbnail_size)
+        self.quality = app.config.get('IMAGE_VARIANT_QUALITY', self.quality)
+        self.workers = app.config.get('IMAGE_VARIANT_WORKERS', self.workers)
+        app.extensions['image_variants'] = self
+        if Image is None:
+            app.logger.warning('Pillow is not installed; image variants are disabled')
+
+    def submit(self, path):
+        """Queue variant generation for a committed image; returns the future or None"""
+        if not path or Image is None or path.rsplit('.', 1)[-1].lower() not in SAVE_FORMATS:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='image-variants')
+        return self._executor.submit(self._process, path)
+
+    def resolve(self, path, width, webp=False):
+        """Path of the smallest generated variant at least ``width`` wide, or None"""
+        if not path.startswith('images/') or Image is None:
+            return None
+        extension = path.rsplit('.', 1)[-1].lower()
+        for size in self.widths:
+            if size < width:
+                continue
+            for candidate in ([variant_path(path, size, 'webp')] if webp else []) + [variant_path(path, size, extension)]:
+                if storage.exists(candidate):
+                    return candidate
+        return None
+
+    def _process(self, path):
+        with self.app.app_context():
+            try:
+                variants = generate_variants(path, self.widths, self.thumbnail_size, self.quality)
+                if variants is not None:
+                    self.record(path, variants)
+                return variants
+            except Exception:
+                self.app.logger.exception('Failed to generate variants for %s', path)
+
+    def record(self, path, variants):
+        """Store the variants on every post using the image"""
+        post = Post.__table__
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                db.select(post.c.id, post.c.user_id).where(post.c.image_url == path)
+            ).all()
+            # updated_at moves on so cached copies and ETags pick up the variants
+            conn.execute(post.update().where(post.c.image_url == path).values(image_variants=variants))
+        tags = {'posts'}
+        for post_id, user_id in rows:
+            tags.update((f'post:{post_id}', f'user:{user_id}'))
+        response_cache.invalidate(*sorted(tags))
+
+
+image_variants = ImageVariants()
@@ -0,0 +1,45 @@
+"""
+JSON encoding for API responses.
+
+``JSONProvider`` encodes with orjson when it is installed, which handles
+dicts, lists and datetimes natively in C, and falls back to Flask's
+standard encoder otherwise. Both write datetimes in ISO 8601, so models
+can hand datetime values straight to ``jsonify``.
+"""
+
+from datetime import date
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        # Flask's encoder would write HTTP dates
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def options(self):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options()).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            # Indented output for debugging
+            return super().response(*args, **kwargs)
+        # Encode straight to bytes instead of through a str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.options() | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -6,11 +6,16 @@ Run this script to update your existing database with new features
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from config import Config
+from models import User, Post, Comment, Tag, CategoryStat, Media, post_tag, parse_tags, html_to_text
+from file_utils import hash_file
+from image_variants import generate_variants
+from storage import storage
 import os
 
 app = Flask(__name__)
 app.config.from_object(Config)
 db = SQLAlchemy(app)
+storage.init_app(app)
 
 def migrate_database():
     """Add new columns to existing tables"""
@@ -112,5 +117,207 @@ def migrate_database():
             print("This might be because the columns already exist or there's a database issue.")
             print("The app will still work, but some new features may not be available.")
 
+def migrate_tags():
+    """Create the tag tables and backfill them from the post.tags column"""
+    with app.app_context():
+        try:
+            Tag.__table__.create(bind=db.engine, checkfirst=True)
+            post_tag.create(bind=db.engine, checkfirst=True)
+            print("✓ Created tag and post_tag tables")
+            
+            tag_table = Tag.__table__
+            with db.engine.begin() as conn:
+                tag_ids = dict(conn.execute(db.select(tag_table.c.name, tag_table.c.id)).all())
+                linked = set(conn.execute(db.select(post_tag.c.post_id, post_tag.c.tag_id)).all())
+                posts = conn.execute(db.select(Post.__table__.c.id, Post.__table__.c.tags)).all()
+                
+                links = 0
+                for post_id, tags in posts:
+                    for name in parse_tags(tags):
+                        key = Tag.normalize(name)
+                        if key not in tag_ids:
+                            result = conn.execute(tag_table.insert().values(name=key))
+                            tag_ids[key] = result.inserted_primary_key[0]
+                        if (post_id, tag_ids[key]) not in linked:
+                            conn.execute(post_tag.insert().values(post_id=post_id, tag_id=tag_ids[key]))
+                            linked.add((post_id, tag_ids[key]))
+                            links += 1
+            print(f"✓ Backfilled {len(tag_ids)} tags and {links} post tags")
+            
+        except Exception as e:
+            print(f"❌ Tag migration failed: {e}")
+
+def migrate_category_stats():
+    """Create the category_stat table and fill it from published posts"""
+    with app.app_context():
+        try:
+            CategoryStat.__table__.create(bind=db.engine, checkfirst=True)
+            
+            post = Post.__table__
+            stat = CategoryStat.__table__
+            with db.engine.begin() as conn:
+                conn.execute(stat.delete())
+                conn.execute(stat.insert().from_select(
+                    ['category', 'post_count', 'latest_post_at'],
+                    db.select(post.c.category, db.func.count(post.c.id), db.func.max(post.c.created_at))
+                    .where(post.c.status == 'published', post.c.category.isnot(None))
+                    .group_by(post.c.category)
+                ))
+            print("✓ Filled category_stat table")
+            
+        except Exception as e:
+            print(f"❌ Category stats migration failed: {e}")
+
+def migrate_media():
+    """Move referenced uploads to content-addressed names and count their references"""
+    with app.app_context():
+        try:
+            Media.__table__.create(bind=db.engine, checkfirst=True)
+            
+            media = Media.__table__
+            references = [
+                (Post.__table__, 'image_url'),
+                (Post.__table__, 'video_url'),
+                (User.__table__, 'avatar_url'),
+            ]
+            moves = {}
+            with db.engine.begin() as conn:
+                tracked = set(conn.execute(db.select(media.c.path)).scalars())
+                counts = {}
+                for table, column_name in references:
+                    column = table.c[column_name]
+                    rows = conn.execute(db.select(table.c.id, column).where(column.isnot(None), column != '')).all()
+                    for row_id, path in rows:
+                        if path not in tracked and path not in moves:
+                            file_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+                            if not os.path.isfile(file_path):
+                                continue
+                            folder, filename = path.rsplit('/', 1)
+                            checksum = hash_file(file_path)
+                            moves[path] = (f"{folder}/{checksum}.{filename.rsplit('.', 1)[-1].lower()}", checksum, os.path.getsize(file_path))
+                        if path not in moves:
+                            continue
+                        new_path = moves[path][0]
+                        conn.execute(table.update().where(table.c.id == row_id).values({column_name: new_path}))
+                        counts[new_path] = counts.get(new_path, 0) + 1
+                
+                sizes = {new_path: (checksum, size) for new_path, checksum, size in moves.values()}
+                for path, count in counts.items():
+                    if path in tracked:
+                        conn.execute(media.update().where(media.c.path == path).values(ref_count=media.c.ref_count + count))
+                    else:
+                        checksum, size = sizes[path]
+                        conn.execute(media.insert().values(path=path, sha256=checksum, size=size, ref_count=count))
+            
+            # Rename files only once the references point at the new names
+            for path, (new_path, _, _) in moves.items():
+                source = os.path.join(app.config['UPLOAD_FOLDER'], path)
+                target = os.path.join(app.config['UPLOAD_FOLDER'], new_path)
+                if source == target:
+                    continue
+                if os.path.exists(target):
+                    os.remove(source)
+                else:
+                    os.replace(source, target)
+            print(f"✓ Moved {len(moves)} uploads to {len(sizes)} content-addressed files")
+            
+        except Exception as e:
+            print(f"❌ Media migration failed: {e}")
+
+def migrate_image_variants():
+    """Add the image_variants column and resize the images of existing posts"""
+    with app.app_context():
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(db.text("""
+                    ALTER TABLE post ADD COLUMN image_variants JSON;
+                """))
+                conn.commit()
+            print("✓ Added image_variants column to post table")
+        except Exception as e:
+            print(f"❌ Image variants column not added: {e}")
+            print("This usually means the column already exists.")
+        
+        try:
+            post = Post.__table__
+            with db.engine.begin() as conn:
+                paths = conn.execute(
+                    db.select(post.c.image_url).distinct()
+                    .where(post.c.image_url.isnot(None), post.c.image_variants.is_(None))
+                ).scalars().all()
+                resized = 0
+                for path in paths:
+                    try:
+                        variants = generate_variants(
+                            path, app.config['IMAGE_VARIANT_WIDTHS'],
+                            app.config['IMAGE_THUMBNAIL_SIZE'], app.config['IMAGE_VARIANT_QUALITY']
+                        )
+                    except OSError as e:
+                        print(f"  Skipped {path}: {e}")
+                        continue
+                    if variants is not None:
+                        conn.execute(post.update().where(post.c.image_url == path).values(image_variants=variants))
+                        resized += 1
+            print(f"✓ Generated variants for {resized} of {len(paths)} images")
+            
+        except Exception as e:
+            print(f"❌ Image variant generation failed: {e}")
+
+def migrate_search_text():
+    """Add the plain-text copy of post content that the search index covers"""
+    with app.app_context():
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(db.text("""
+                    ALTER TABLE post ADD COLUMN content_text TEXT;
+                """))
+                conn.commit()
+            print("✓ Added content_text column to post table")
+        except Exception as e:
+            print(f"❌ Content text column not added: {e}")
+            print("This usually means the column already exists.")
+        
+        try:
+            post = Post.__table__
+            with db.engine.begin() as conn:
+                rows = conn.execute(
+                    db.select(post.c.id, post.c.content).where(post.c.content_text.is_(None))
+                ).all()
+                for post_id, content in rows:
+                    conn.execute(post.update().where(post.c.id == post_id).values(content_text=html_to_text(content)))
+                
+                # The old index covered the raw HTML; the app rebuilds it on startup
+                for trigger in ('post_fts_ai', 'post_fts_ad', 'post_fts_au'):
+                    conn.execute(db.text(f"DROP TRIGGER IF EXISTS {trigger}"))
+                conn.execute(db.text("DROP TABLE IF EXISTS post_fts"))
+            print(f"✓ Filled content_text for {len(rows)} posts")
+            
+        except Exception as e:
+            print(f"❌ Content text migration failed: {e}")
+
+def migrate_indexes():
+    """Create the indexes declared on the models that the database is missing"""
+    with app.app_context():
+        try:
+            for table in (Post.__table__, Comment.__table__, post_tag):
+                for index in sorted(table.indexes, key=lambda index: index.name):
+                    index.create(bind=db.engine, checkfirst=True)
+                    print(f"✓ Index {index.name} on {table.name} table")
+            
+            # Refresh planner statistics so the new indexes get used
+            with db.engine.connect() as conn:
+                conn.execute(db.text("ANALYZE;"))
+                conn.commit()
+            print("✓ Analyzed database")
+            
+        except Exception as e:
+            print(f"❌ Index migration failed: {e}")
+
 if __name__ == '__main__':
-    migrate_database()
\ No newline at end of file
+    migrate_database()
+    migrate_tags()
+    migrate_category_stats()
+    migrate_media()
+    migrate_image_variants()
+    migrate_search_text()
+    migrate_indexes()
\ No newline at end of file
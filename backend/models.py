@@ -1,7 +1,42 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
+import html
+import re
 
-db = SQLAlchemy()
+class RoutingSession(Session):
+    """Session that reads from the replica chosen for the current request, see replicas.py"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # Flushes always write to the primary
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get('replica_engine')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# INSERT constructs supporting ON CONFLICT, by dialect
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """Run the given PRAGMA statements on every new connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    
+    @db.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+# Characters of content included in post summaries
+EXCERPT_LENGTH = 200
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -21,7 +56,7 @@ class User(db.Model):
             'bio': self.bio,
             'avatar_url': self.avatar_url,
             'is_admin': self.is_admin,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
 
@@ -37,8 +72,20 @@ class Comment(db.Model):
     author = db.relationship('User', backref='comments')
     post = db.relationship('Post', backref='comments')
     replies = db.relationship('Comment', backref=db.backref('parent', remote_side=[id]))
+
+    __table_args__ = (
+        # Thread for a post, oldest first
+        db.Index('ix_comment_post_id_created_at', 'post_id', 'created_at'),
+        # Lazy-loaded replies of a comment
+        db.Index('ix_comment_parent_id', 'parent_id'),
+        # Recent comments on the dashboard
+        db.Index('ix_comment_created_at', 'created_at'),
+    )
     
-    def to_dict(self):
+    def to_dict(self, replies=None):
+        # Pass replies explicitly to avoid lazy-loading them per comment
+        if replies is None:
+            replies = [reply.to_dict() for reply in self.replies] if self.replies else []
         return {
             'id': self.id,
             'content': self.content,
@@ -46,10 +93,108 @@ class Comment(db.Model):
             'post_id': self.post_id,
             'parent_id': self.parent_id,
             'author': self.author.username if self.author else 'Unknown',
-            'created_at': self.created_at.isoformat(),
-            'replies': [reply.to_dict() for reply in self.replies] if self.replies else []
+            'created_at': self.created_at,
+            'replies': replies
         }
 
+    @staticmethod
+    def build_tree(items):
+        """Nest a flat list of comment dicts, ordered oldest first, into reply trees"""
+        nodes = {}
+        roots = []
+        for node in items:
+            node['replies'] = []
+            nodes[node['id']] = node
+            if node['parent_id'] is None:
+                roots.append(node)
+        for node in items:
+            parent = nodes.get(node['parent_id'])
+            if parent is not None:
+                parent['replies'].append(node)
+        # Top-level comments are listed newest first, replies oldest first
+        roots.reverse()
+        return roots
+
+# Markup dropped from post content before it is indexed for search
+SCRIPT_STYLE = re.compile(r'<(script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+HTML_TAG = re.compile(r'<[^>]*>')
+
+def html_to_text(value):
+    """Plain text of rich-text HTML: tags removed, entities decoded, whitespace collapsed"""
+    if not value:
+        return value
+    text = HTML_TAG.sub(' ', SCRIPT_STYLE.sub(' ', value))
+    return ' '.join(html.unescape(text).split())
+
+def parse_tags(value):
+    """Tag names from a comma-separated string or a list, without blanks or duplicates"""
+    if isinstance(value, str):
+        value = value.split(',')
+    names = []
+    seen = set()
+    for name in value or []:
+        name = str(name).strip()
+        if name and name.lower() not in seen:
+            seen.add(name.lower())
+            names.append(name)
+    return names
+
+
+post_tag = db.Table(
+    'post_tag',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    # Posts carrying a tag
+    db.Index('ix_post_tag_tag_id_post_id', 'tag_id', 'post_id')
+)
+
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)  # lower-cased
+
+    @staticmethod
+    def normalize(name):
+        return name.strip().lower()
+
+    @classmethod
+    def get_or_create(cls, names):
+        """
+        Tag rows for the given names, adding any that do not exist yet.
+        Raises ValueError for a name longer than the column allows.
+        """
+        keys = list(dict.fromkeys(cls.normalize(name) for name in names))
+        if not keys:
+            return []
+        max_length = cls.name.type.length
+        if any(len(key) > max_length for key in keys):
+            raise ValueError(f"Tag names can be at most {max_length} characters")
+        
+        existing = {tag.name: tag for tag in cls.query.filter(cls.name.in_(keys))}
+        missing = [key for key in keys if key not in existing]
+        if missing:
+            cls.insert_missing(missing)
+            existing.update((tag.name, tag) for tag in cls.query.filter(cls.name.in_(missing)))
+        return [existing[key] for key in keys]
+
+    @classmethod
+    def insert_missing(cls, keys):
+        """Insert tag names, skipping any another request added meanwhile"""
+        insert = UPSERT_INSERTS.get(db.engine.dialect.name)
+        if insert is not None:
+            db.session.execute(
+                insert(cls).values([{'name': key} for key in keys])
+                .on_conflict_do_nothing(index_elements=[cls.name])
+            )
+            return
+        for key in keys:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(cls(name=key))
+            except IntegrityError:
+                pass
+
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -60,26 +205,157 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     image_url = db.Column(db.String(255), nullable=True)
     video_url = db.Column(db.String(255), nullable=True)
+    image_variants = db.Column(db.JSON, nullable=True)  # Resized copies of the image, see image_variants.py
     created_at = db.Column(db.DateTime, server_default=db.func.now())
     updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
     views = db.Column(db.Integer, default=0)
+    # Content without markup, indexed for search; kept in step by update_content_text
+    content_text = db.deferred(db.Column(db.Text, nullable=True))
+    
+    # Start of the content, loaded in place of the full body for summaries
+    excerpt = db.column_property(db.func.substr(content, 1, EXCERPT_LENGTH), deferred=True)
     
     # Relationship to User
     author = db.relationship('User', backref='posts')
+    # Normalized copy of tags, used for filtering and counts
+    tag_list = db.relationship('Tag', secondary=post_tag, backref='posts')
+
+    __table_args__ = (
+        # Feed order and keyset pagination seek
+        db.Index('ix_post_status_created_at_id', 'status', 'created_at', 'id'),
+        # Feed filtered by category
+        db.Index('ix_post_status_category_created_at', 'status', 'category', 'created_at'),
+        # Published posts on a user profile
+        db.Index('ix_post_user_id_status_created_at', 'user_id', 'status', 'created_at'),
+        # Recent posts on the dashboard
+        db.Index('ix_post_created_at', 'created_at'),
+    )
     
+    # Fields returned by each view of a post
+    FULL_FIELDS = ('id', 'title', 'content', 'category', 'tags', 'status', 'user_id', 'author',
+                   'image_url', 'image_variants', 'video_url', 'views', 'created_at', 'updated_at')
+    SUMMARY_FIELDS = ('id', 'title', 'excerpt', 'category', 'tags', 'status', 'user_id', 'author',
+                      'image_url', 'image_variants', 'video_url', 'views', 'created_at', 'updated_at')
+
+    def to_dict(self, fields=None):
+        return {name: POST_FIELDS[name](self) for name in (fields or self.FULL_FIELDS)}
+
+    def to_summary_dict(self):
+        return self.to_dict(self.SUMMARY_FIELDS)
+
+    def set_tags(self, value):
+        """
+        Set tags from a comma-separated string or list, keeping tag_list in
+        step. Raises ValueError if they don't fit the columns.
+        """
+        names = parse_tags(value)
+        tags = ','.join(names)
+        if len(tags) > Post.tags.type.length:
+            raise ValueError(f"Tags can be at most {Post.tags.type.length} characters in total")
+        self.tag_list = Tag.get_or_create(names)
+        self.tags = tags
+
+
+
+@db.event.listens_for(Post.content, 'set')
+def update_content_text(post, value, oldvalue, initiator):
+    post.content_text = html_to_text(value)
+
+
+class CategoryStat(db.Model):
+    """Published post count per category, kept current by the post write routes"""
+    category = db.Column(db.String(50), primary_key=True)
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+    latest_post_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def refresh(cls, *categories):
+        """
+        Recompute the stats of the given categories from their published
+        posts. Categories left without posts keep a row with a zero count.
+        """
+        categories = sorted({category for category in categories if category})
+        if not categories:
+            return
+        db.session.flush()
+        cls.insert_missing(categories)
+        # Lock the rows (in a fixed order) so concurrent writers recount one
+        # after another, each seeing the other's committed posts
+        stats = (
+            cls.query.filter(cls.category.in_(categories))
+            .order_by(cls.category)
+            .with_for_update()
+            .populate_existing()
+            .all()
+        )
+        counts = (
+            db.session.query(Post.category, db.func.count(Post.id), db.func.max(Post.created_at))
+            .filter(Post.status == 'published', Post.category.in_(categories))
+            .group_by(Post.category)
+            .all()
+        )
+        rows = {category: (count, latest) for category, count, latest in counts}
+        for stat in stats:
+            stat.post_count, stat.latest_post_at = rows.get(stat.category, (0, None))
+
+    @classmethod
+    def insert_missing(cls, categories):
+        """Add empty rows for categories without one, skipping any another request added meanwhile"""
+        insert = UPSERT_INSERTS.get(db.engine.dialect.name)
+        if insert is not None:
+            db.session.execute(
+                insert(cls).values([{'category': category, 'post_count': 0} for category in categories])
+                .on_conflict_do_nothing(index_elements=[cls.category])
+            )
+            return
+        for category in categories:
+            if db.session.get(cls, category) is not None:
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.add(cls(category=category, post_count=0))
+            except IntegrityError:
+                pass
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every category, e.g. for a database that predates this table"""
+        cls.query.delete()
+        categories = db.session.query(Post.category).filter(Post.status == 'published').distinct()
+        cls.refresh(*(category for (category,) in categories))
+
     def to_dict(self):
         return {
-            'id': self.id,
-            'title': self.title,
-            'content': self.content,
-            'category': self.category,
-            'tags': self.tags.split(',') if self.tags else [],
-            'status': self.status,
-            'user_id': self.user_id,
-            'author': self.author.username if self.author else 'Unknown',
-            'image_url': self.image_url,
-            'video_url': self.video_url,
-            'views': self.views,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat() if self.updated_at else self.created_at.isoformat()
+            'name': self.category,
+            'count': self.post_count,
+            'latest_post_at': self.latest_post_at
         }
+
+
+class Media(db.Model):
+    """An uploaded file stored under the SHA-256 of its content"""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), unique=True, nullable=False)  # e.g. images/<sha256>.jpg
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Posts and users using the file
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+
+POST_FIELDS = {
+    'id': lambda post: post.id,
+    'title': lambda post: post.title,
+    'content': lambda post: post.content,
+    'excerpt': lambda post: post.excerpt,
+    'category': lambda post: post.category,
+    'tags': lambda post: post.tags.split(',') if post.tags else [],
+    'status': lambda post: post.status,
+    'user_id': lambda post: post.user_id,
+    'author': lambda post: post.author.username if post.author else 'Unknown',
+    'image_url': lambda post: post.image_url,
+    'image_variants': lambda post: post.image_variants,
+    'video_url': lambda post: post.video_url,
+    'views': lambda post: post.views,
+    'created_at': lambda post: post.created_at,
+    'updated_at': lambda post: post.updated_at or post.created_at
+}
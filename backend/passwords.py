@@ -0,0 +1,193 @@
+"""
+Password hashing off the request threads.
+
+Password hashes use deliberately slow KDFs. ``password_hasher`` runs them
+in a small process pool behind a bounded queue: a burst of logins holds at
+most PASSWORD_HASH_MAX_PENDING server threads, and requests beyond that are
+turned away at once instead of starving every other endpoint.
+
+PASSWORD_HASH_METHOD takes werkzeug's method strings, e.g.
+``scrypt:32768:8:1`` or ``pbkdf2:sha256:600000``. Hashes made with other
+parameters are upgraded on the user's next successful login.
+"""
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+class HasherBusy(Exception):
+    """Too many hashing requests are already waiting"""
+
+
+def _timed_hash(password, method):
+    started = time.time()
+    hashed = generate_password_hash(password, method=method)
+    return hashed, started, time.time()
+
+
+def _timed_check(hashed, password):
+    started = time.time()
+    matches = check_password_hash(hashed, password)
+    return matches, started, time.time()
+
+
+def _noop():
+    return None
+
+
+def method_prefix(method):
+    """
+    The parameters werkzeug writes at the start of a hash made with
+    ``method``, with the defaults it fills in for short names such as
+    ``scrypt``
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = args or (2 ** 15, 8, 1)
+        return f'scrypt:{n}:{r}:{p}'
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f'Unsupported password hash method {method!r}')
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.method = 'scrypt:32768:8:1'
+        self.workers = 2
+        self.max_pending = 2
+        self.timeout = 10
+        self._prefix = method_prefix(self.method)
+        self._executor = None
+        self._broken = False
+        # Called when a worker process dies; None rebuilds the pool in place (see _pool_broke)
+        self.on_broken = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {'completed': 0, 'rejected': 0, 'timed_out': 0, 'rehashed': 0, 'wait': 0.0, 'run': 0.0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING', self.max_pending)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self._prefix = method_prefix(self.method)
+        app.extensions['password_hasher'] = self
+        self.start()
+
+    def start(self):
+        """
+        (Re)start the worker processes. Called from init_app, before the
+        server starts its threads: forking a threaded process can copy locks
+        held by other threads into the children.
+        """
+        self.stop()
+        with self._lock:
+            if self.workers:
+                self._broken = False
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+                # The fork context launches every worker on the first submit
+                self._executor.submit(_noop)
+
+    def stop(self, wait=False):
+        """
+        Shut the worker processes down. A server process that forks workers
+        passes ``wait=True`` so they are reaped first: children forked while
+        they are still registered would try to join them on exit.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def hash(self, password):
+        """Hash a password with the configured method; raises HasherBusy when saturated"""
+        return self._run(_timed_hash, password, self.method)
+
+    def check(self, hashed, password):
+        """Check a password against a stored hash; raises HasherBusy when saturated"""
+        return self._run(_timed_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """True when a stored hash was made with other KDF parameters"""
+        return hashed.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, pending=self._pending, workers=self.workers, max_pending=self.max_pending)
+        completed = stats['completed'] or 1
+        stats['avg_wait_ms'] = round(stats.pop('wait') / completed * 1000, 1)
+        stats['avg_run_ms'] = round(stats.pop('run') / completed * 1000, 1)
+        return stats
+
+    def count_rehash(self):
+        with self._lock:
+            self._stats['rehashed'] += 1
+
+    def _run(self, func, *args):
+        if not self.workers:
+            # PASSWORD_HASH_WORKERS = 0 hashes inline, e.g. for scripts and tests
+            return func(*args)[0]
+
+        with self._lock:
+            if self._broken:
+                self._stats['rejected'] += 1
+                raise HasherBusy()
+            if self._executor is None:
+                raise RuntimeError('password hashing pool is stopped')
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise HasherBusy()
+            self._pending += 1
+            executor = self._executor
+
+        submitted = time.time()
+        try:
+            result, started, finished = executor.submit(func, *args).result(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self._stats['timed_out'] += 1
+            raise HasherBusy()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory)
+            self._pool_broke(executor)
+            raise HasherBusy()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+        with self._lock:
+            self._stats['completed'] += 1
+            self._stats['wait'] += max(started - submitted, 0)
+            self._stats['run'] += finished - started
+        return result
+
+    def _pool_broke(self, executor):
+        with self._lock:
+            if self._executor is not executor or self._broken:
+                # Another request already handled it
+                return
+            self._broken = True
+        if self.on_broken is not None:
+            # e.g. gunicorn retires the worker; the replacement starts a new
+            # pool before it runs any threads
+            current_app.logger.error('Password hashing pool broke; retiring this process')
+            self.on_broken()
+            return
+        # Waitress and uvicorn have no single-threaded process to rebuild
+        # from, so fork here. Locks other threads hold at this moment are
+        # copied into the new workers locked; the workers only run the hash
+        # functions, which take none of them.
+        current_app.logger.error('Password hashing pool broke; restarting it')
+        self.start()
+
+
+password_hasher = PasswordHasher()
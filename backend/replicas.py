@@ -0,0 +1,82 @@
+"""
+Read-replica routing.
+
+Handlers marked ``@replica_router.read_only`` run their queries on one of
+the ``replica*`` binds built from DATABASE_REPLICA_URLS (see RoutingSession
+in models.py); all other handlers, and every flush, use the primary
+database. After a user writes, their reads stay on the primary for
+REPLICA_STICKY_SECONDS so they see their own changes despite replication
+lag. Responses cached from a replica expire within the same window.
+"""
+
+import random
+import time
+from functools import wraps
+from flask import g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from cache import response_cache, MemoryBackend, RedisBackend
+from models import db
+
+REPLICA_PREFIX = 'replica'
+
+
+class ReplicaRouter:
+    def __init__(self, app=None):
+        self.keys = []
+        self.sticky_seconds = 10
+        self.writes = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.keys = sorted(
+            key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+            if key.startswith(REPLICA_PREFIX)
+        )
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', self.sticky_seconds)
+        # Recent writers must be known to every server when the cache is shared
+        if isinstance(response_cache.backend, RedisBackend):
+            self.writes = response_cache.backend
+        else:
+            self.writes = MemoryBackend(app.config.get('REPLICA_STICKY_MAX_USERS', 10000))
+        app.after_request(self._remember_write)
+        app.extensions['replica_router'] = self
+
+    @property
+    def enabled(self):
+        return bool(self.keys)
+
+    def recently_wrote(self, user_id):
+        return self.writes.get(f'wrote:{user_id}') is not None
+
+    def read_only(self, view):
+        """Run a handler's queries on a replica unless the user has just written"""
+        @wraps(view)
+        def wrapper(**kwargs):
+            if self.enabled and not self.recently_wrote(self._identity()):
+                g.replica_engine = db.engines[random.choice(self.keys)]
+            return view(**kwargs)
+        return wrapper
+
+    def _identity(self):
+        try:
+            verify_jwt_in_request(optional=True)
+            return get_jwt_identity()
+        except Exception:
+            # Bad or expired tokens are the view's business, not routing's
+            return None
+
+    def _remember_write(self, response):
+        if not self.enabled or request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400:
+            return response
+        try:
+            user_id = get_jwt_identity()
+        except RuntimeError:
+            # No verified JWT in this request
+            return response
+        if user_id is not None:
+            self.writes.set(f'wrote:{user_id}', time.time(), self.sticky_seconds)
+        return response
+
+
+replica_router = ReplicaRouter()
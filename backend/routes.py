@@ -1,11 +1,30 @@
-from flask import Blueprint, request, jsonify
+import base64
+from datetime import datetime
+from flask import Blueprint, request, jsonify, abort, current_app
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Post, Comment
-from file_utils import save_uploaded_file
+from models import db, User, Post, Comment, Tag, CategoryStat, Media, post_tag, POST_FIELDS
+from file_utils import (
+    save_uploaded_file, start_chunked_upload, load_chunked_upload,
+    append_chunk, finalize_chunked_upload, release_media, ChunkConflict,
+    add_media_reference, direct_upload_path
+)
+from search import apply_search, highlight_snippet
+from view_counter import view_counter
+from image_variants import image_variants
+from storage import storage
+from cache import response_cache
+from passwords import password_hasher, HasherBusy
+from replicas import replica_router
+from serializers import post_serializer, comment_serializer
+from conditional import make_etag, not_modified, set_validators
 
 api = Blueprint('api', __name__)
 
+def hasher_busy():
+    response = jsonify({"message": "Too many sign-in attempts right now, please retry"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @api.route('/auth/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -15,7 +34,10 @@ def register():
     if User.query.filter_by(username=username).first():
         return jsonify({"message": "Username already exists"}), 400
         
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = password_hasher.hash(password)
+    except HasherBusy:
+        return hasher_busy()
     new_user = User(username=username, password=hashed_password)
     
     # First user is admin for simplicity
@@ -24,6 +46,7 @@ def register():
         
     db.session.add(new_user)
     db.session.commit()
+    response_cache.invalidate('users')
     
     return jsonify({"message": "User created successfully"}), 201
 
@@ -35,7 +58,22 @@ def login():
     
     user = User.query.filter_by(username=username).first()
     
-    if user and check_password_hash(user.password, password):
+    try:
+        valid = user is not None and password_hasher.check(user.password, password)
+    except HasherBusy:
+        return hasher_busy()
+    
+    if valid and password_hasher.needs_rehash(user.password):
+        # Upgrade the stored hash to the current KDF parameters; a busy pool
+        # just leaves it for a later login
+        try:
+            user.password = password_hasher.hash(password)
+            db.session.commit()
+            password_hasher.count_rehash()
+        except HasherBusy:
+            pass
+    
+    if valid:
         access_token = create_access_token(identity=str(user.id))
         return jsonify(access_token=access_token, user=user.to_dict()), 200
         
@@ -45,17 +83,67 @@ def login():
 def test_connection():
     return jsonify({"message": "API connection working!", "status": "success"}), 200
 
-@api.route('/posts', methods=['GET'])
-def get_posts():
-    # Get query parameters for filtering
+def encode_cursor(post):
+    """Opaque feed cursor pointing just past ``post``"""
+    raw = f"{post.created_at.isoformat(sep=' ')},{post.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Return ``(created_at, id)`` from a cursor, or None if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, post_id = raw.rsplit(',', 1)
+        # Same text as SQLite stores, so the seek can compare it directly
+        return datetime.fromisoformat(created_at).isoformat(sep=' '), int(post_id)
+    except ValueError:
+        return None
+
+def requested_per_page(default=10):
+    """?per_page= capped at MAX_PER_PAGE; None if it is not a positive number"""
+    try:
+        per_page = int(request.args.get('per_page', default))
+    except ValueError:
+        return None
+    if per_page < 1:
+        return None
+    return min(per_page, current_app.config.get('MAX_PER_PAGE', 100))
+
+def requested_post_fields():
+    """Fields asked for with ?fields= or ?view=summary|full; None if any is unknown"""
+    fields = request.args.get('fields')
+    if fields:
+        # Unique names in the order given; a repeated label breaks the column select
+        fields = tuple(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+        if not fields or any(name not in POST_FIELDS for name in fields):
+            return None
+        return fields
+    if request.args.get('view') == 'summary':
+        return Post.SUMMARY_FIELDS
+    return Post.FULL_FIELDS
+
+def serialize_posts(rows, highlighted, serializer):
+    if not highlighted:
+        return [serializer(row) for row in rows]
+    items = []
+    for row in rows:
+        item = serializer(row)
+        item['snippet'] = highlight_snippet(row.snippet)
+        items.append(item)
+    return items
+
+def feed_query(query=None):
+    """
+    Post query (``Post.query`` unless another is given, e.g. a serializer's)
+    filtered by the request's status, category and search arguments
+    """
     category = request.args.get('category')
+    tag = request.args.get('tag')
     search = request.args.get('search')
     status = request.args.get('status', 'published')
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
     
     # Build query
-    query = Post.query
+    if query is None:
+        query = Post.query
     
     # Filter by status
     if status:
@@ -65,37 +153,150 @@ def get_posts():
     if category and category != 'all':
         query = query.filter(Post.category == category)
     
-    # Search in title and content
-    if search:
-        query = query.filter(
-            db.or_(
-                Post.title.contains(search),
-                Post.content.contains(search)
-            )
+    # Filter by tag through the post_tag index
+    if tag:
+        query = (
+            query.join(post_tag, post_tag.c.post_id == Post.id)
+            .join(Tag, Tag.id == post_tag.c.tag_id)
+            .filter(Tag.name == Tag.normalize(tag))
         )
     
+    # Search in title and content (full-text match when indexed); cursor
+    # mode keeps date order so the seek key stays valid
+    highlighted = False
+    if search:
+        query, highlighted = apply_search(query, search, rank='after' not in request.args)
+    
+    return query, highlighted
+
+def rows_etag(name, rows, *parts):
+    """
+    ETag of a list response from the rows it is built from, so every field
+    (author names and views included) counts, without an extra query
+    """
+    return make_etag(name, sorted(request.args.items(multi=True)), *parts, [tuple(row) for row in rows])
+
+@api.route('/posts', methods=['GET'])
+@replica_router.read_only
+@response_cache.cached('posts')
+def get_posts():
+    # Get query parameters for pagination
+    page = int(request.args.get('page', 1))
+    per_page = requested_per_page()
+    if per_page is None:
+        return jsonify({"message": "per_page must be a positive number"}), 400
+    # Cursor mode: ?after= (empty for the first page) switches to keyset pagination
+    after = request.args.get('after')
+    
+    fields = requested_post_fields()
+    if fields is None:
+        return jsonify({"message": f"Unknown field; available: {', '.join(POST_FIELDS)}"}), 400
+    
+    # Select only the columns the requested fields need, as plain rows
+    serializer = post_serializer(fields)
+    query, highlighted = feed_query(serializer.query())
+    
+    if after is not None:
+        return get_posts_page_after(query, after, per_page, highlighted, serializer)
+    
     # Order by creation date
     query = query.order_by(Post.created_at.desc())
     
     # Paginate
     posts = query.paginate(page=page, per_page=per_page, error_out=False)
     
-    return jsonify({
-        'posts': [post.to_dict() for post in posts.items],
+    # Answer a conditional request before serializing the rows
+    etag = rows_etag('posts', posts.items, posts.total)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    return set_validators(jsonify({
+        'posts': serialize_posts(posts.items, highlighted, serializer),
         'total': posts.total,
         'pages': posts.pages,
         'current_page': page,
         'has_next': posts.has_next,
         'has_prev': posts.has_prev
-    }), 200
+    }), etag), 200
+
+def get_posts_page_after(query, after, per_page, highlighted, serializer):
+    """Keyset page of the feed: seeks on (created_at, id) instead of OFFSET"""
+    include_total = request.args.get('include_total', '').lower() in ('1', 'true')
+    total = query.order_by(None).count() if include_total else None
+    
+    if after:
+        key = decode_cursor(after)
+        if key is None:
+            return jsonify({"message": "Invalid cursor"}), 400
+        created_at, post_id = key
+        if db.engine.dialect.name == 'sqlite':
+            created_at = db.literal(created_at, db.String)
+        else:
+            created_at = datetime.fromisoformat(created_at)
+        query = query.filter(db.or_(
+            Post.created_at < created_at,
+            db.and_(Post.created_at == created_at, Post.id < post_id)
+        ))
+    
+    # Fetch one extra row to learn whether another page exists
+    rows = query.order_by(Post.created_at.desc(), Post.id.desc()).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    
+    last = rows[-1] if rows else None
+    
+    etag = rows_etag('posts', rows, has_next, total)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    result = {
+        'posts': serialize_posts(rows, highlighted, serializer),
+        'next_cursor': encode_cursor(last) if has_next else None,
+        'has_next': has_next
+    }
+    if include_total:
+        result['total'] = total
+    return set_validators(jsonify(result), etag), 200
+
+def cached_for_anonymous(name, tags, loader):
+    if response_cache.bypass():
+        return loader()
+    return response_cache.get_or_set(name, tags, loader)
+
+def post_validators(id):
+    row = (
+        db.session.query(Post.updated_at, Post.created_at, User.username)
+        .outerjoin(User, Post.user_id == User.id)
+        .filter(Post.id == id)
+        .first()
+    )
+    if row is None:
+        abort(404)
+    last_modified = row.updated_at or row.created_at
+    # Views are left out on purpose: they change on every read
+    return make_etag('post', id, last_modified, row.username), last_modified
 
 @api.route('/posts/<int:id>', methods=['GET'])
+@replica_router.read_only
 def get_post(id):
-    post = Post.query.get_or_404(id)
-    # Increment view count
-    post.views += 1
-    db.session.commit()
-    return jsonify(post.to_dict()), 200
+    etag, last_modified = cached_for_anonymous(
+        f'post-validators:{id}', [f'post:{id}'], lambda: post_validators(id)
+    )
+    
+    # Count the view in memory; it is written back in batches
+    view_counter.record(id)
+    
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    
+    data = dict(cached_for_anonymous(
+        f'post:{id}', [f'post:{id}'], lambda: Post.query.get_or_404(id).to_dict()
+    ))
+    data['views'] = (data['views'] or 0) + view_counter.pending(id)
+    return set_validators(jsonify(data), etag, last_modified), 200
 
 @api.route('/posts', methods=['POST'])
 @jwt_required()
@@ -115,10 +316,13 @@ def create_post():
             title=title,
             content=content,
             category=category,
-            tags=tags,
             status=status,
             user_id=current_user_id
         )
+        try:
+            new_post.set_tags(tags)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
         
         # Handle image upload
         if 'image' in request.files:
@@ -141,13 +345,19 @@ def create_post():
             title=data.get('title'),
             content=data.get('content'),
             category=data.get('category', 'General'),
-            tags=data.get('tags', ''),
             status=data.get('status', 'published'),
             user_id=current_user_id
         )
+        try:
+            new_post.set_tags(data.get('tags', ''))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
     
     db.session.add(new_post)
+    CategoryStat.refresh(new_post.category)
     db.session.commit()
+    response_cache.invalidate('posts', 'categories', 'tags', f'user:{new_post.user_id}')
+    image_variants.submit(new_post.image_url)
     
     return jsonify(new_post.to_dict()), 201
 
@@ -162,12 +372,18 @@ def update_post(id):
     if int(post.user_id) != int(current_user_id) and not (user and user.is_admin):
         return jsonify({"message": "Permission denied"}), 403
     
+    old_category = post.category
+    
     # Handle both JSON and multipart/form-data requests
     if request.content_type and 'multipart/form-data' in request.content_type:
         post.title = request.form.get('title', post.title)
         post.content = request.form.get('content', post.content)
         post.category = request.form.get('category', post.category)
-        post.tags = request.form.get('tags', post.tags)
+        if 'tags' in request.form:
+            try:
+                post.set_tags(request.form['tags'])
+            except ValueError as e:
+                return jsonify({"message": str(e)}), 400
         post.status = request.form.get('status', post.status)
         
         # Handle image upload
@@ -175,13 +391,16 @@ def update_post(id):
             image_file = request.files['image']
             image_url = save_uploaded_file(image_file, 'image')
             if image_url:
+                release_media(post.image_url)
                 post.image_url = image_url
+                post.image_variants = None
         
         # Handle video upload
         if 'video' in request.files:
             video_file = request.files['video']
             video_url = save_uploaded_file(video_file, 'video')
             if video_url:
+                release_media(post.video_url)
                 post.video_url = video_url
                 
     else:
@@ -190,10 +409,18 @@ def update_post(id):
         post.title = data.get('title', post.title)
         post.content = data.get('content', post.content)
         post.category = data.get('category', post.category)
-        post.tags = data.get('tags', post.tags)
+        if 'tags' in data:
+            try:
+                post.set_tags(data['tags'])
+            except ValueError as e:
+                return jsonify({"message": str(e)}), 400
         post.status = data.get('status', post.status)
     
+    CategoryStat.refresh(old_category, post.category)
     db.session.commit()
+    response_cache.invalidate('posts', f'post:{id}', 'categories', 'tags', f'user:{post.user_id}')
+    if post.image_url and post.image_variants is None:
+        image_variants.submit(post.image_url)
     return jsonify(post.to_dict()), 200
 
 @api.route('/posts/<int:id>', methods=['DELETE'])
@@ -207,25 +434,214 @@ def delete_post(id):
     if int(post.user_id) != int(current_user_id) and not (user and user.is_admin):
         return jsonify({"message": "Permission denied"}), 403
         
+    author_id = post.user_id
+    release_media(post.image_url)
+    release_media(post.video_url)
     db.session.delete(post)
+    CategoryStat.refresh(post.category)
     db.session.commit()
+    response_cache.invalidate('posts', f'post:{id}', f'comments:{id}', 'categories', 'tags', f'user:{author_id}')
     
     return jsonify({"message": "Post deleted"}), 200
 
 
 
 
+# Chunked (resumable) uploads for large media
+def upload_status(meta):
+    return {
+        'upload_id': meta['id'],
+        'filename': meta['filename'],
+        'upload_type': meta['upload_type'],
+        'size': meta['size'],
+        'offset': meta['offset']
+    }
+
+def owned_upload(upload_id):
+    meta = load_chunked_upload(upload_id)
+    if meta is None or meta['user_id'] != str(get_jwt_identity()):
+        abort(404)
+    return meta
+
+@api.route('/uploads', methods=['POST'])
+@jwt_required()
+def create_upload():
+    data = request.get_json()
+    upload_type = data.get('upload_type', 'video')
+    if upload_type not in ('image', 'video'):
+        return jsonify({"message": "upload_type must be image or video"}), 400
+    
+    meta = start_chunked_upload(
+        data.get('filename'),
+        upload_type,
+        data.get('size'),
+        get_jwt_identity()
+    )
+    if meta is None:
+        return jsonify({"message": "File type or size not allowed"}), 400
+    return jsonify(upload_status(meta)), 201
+
+@api.route('/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload(upload_id):
+    # Lets a client resume from the last byte the server has
+    return jsonify(upload_status(owned_upload(upload_id))), 200
+
+@api.route('/uploads/<upload_id>', methods=['PATCH'])
+@jwt_required()
+def upload_chunk(upload_id):
+    meta = owned_upload(upload_id)
+    
+    # The chunk must start exactly where the stored bytes end
+    offset = request.args.get('offset', type=int)
+    if offset != meta['offset']:
+        return jsonify({"message": "Offset mismatch", **upload_status(meta)}), 409
+    
+    try:
+        meta['offset'] = append_chunk(meta, request.stream, offset)
+    except ChunkConflict as e:
+        return jsonify({"message": str(e), **upload_status(meta)}), 409
+    except ValueError as e:
+        return jsonify({"message": str(e), **upload_status(meta)}), 400
+    
+    return jsonify(upload_status(meta)), 200
+
+def upload_target_post(data):
+    """The post an upload should be attached to, checked before any file is moved"""
+    if data.get('post_id') is None:
+        return None
+    post = Post.query.get_or_404(data['post_id'])
+    user = User.query.get(get_jwt_identity())
+    if int(post.user_id) != int(get_jwt_identity()) and not (user and user.is_admin):
+        abort(403)
+    return post
+
+def attach_upload(post, upload_type, url):
+    """Commit a stored upload, setting it as the post's image or video"""
+    result = {'url': url}
+    if post is not None:
+        if upload_type == 'video':
+            release_media(post.video_url)
+            post.video_url = url
+        else:
+            release_media(post.image_url)
+            post.image_url = url
+            post.image_variants = None
+    db.session.commit()
+    
+    if post is not None:
+        response_cache.invalidate('posts', f'post:{post.id}', f'user:{post.user_id}')
+        if upload_type == 'image':
+            image_variants.submit(post.image_url)
+        result['post'] = post.to_dict()
+    return result
+
+@api.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@jwt_required()
+def finalize_upload(upload_id):
+    meta = owned_upload(upload_id)
+    data = request.get_json() or {}
+    post = upload_target_post(data)
+    
+    try:
+        url = finalize_chunked_upload(meta, data.get('sha256'))
+    except ValueError as e:
+        return jsonify({"message": str(e), **upload_status(meta)}), 400
+    
+    return jsonify(attach_upload(post, meta['upload_type'], url)), 201
+
+# Direct uploads to object storage, bypassing the API servers
+def direct_upload_request(data):
+    upload_type = data.get('upload_type', 'image')
+    if upload_type not in ('image', 'video'):
+        abort(400)
+    path = direct_upload_path(data.get('filename'), upload_type, data.get('sha256'), data.get('size'))
+    if path is None:
+        abort(400)
+    return upload_type, path
+
+@api.route('/uploads/direct', methods=['POST'])
+@jwt_required()
+def create_direct_upload():
+    if not storage.direct_uploads:
+        return jsonify({"message": "Direct uploads need object storage; use /api/uploads"}), 501
+    data = request.get_json() or {}
+    upload_type, path = direct_upload_request(data)
+    
+    if Media.query.filter_by(path=path).first():
+        # Same content is already stored: skip straight to completing
+        return jsonify({'path': path, 'upload': None}), 200
+    
+    upload = storage.presigned_upload(path, data['sha256'], data['size'])
+    return jsonify({'path': path, 'upload': upload}), 201
+
+@api.route('/uploads/direct/complete', methods=['POST'])
+@jwt_required()
+def complete_direct_upload():
+    if not storage.direct_uploads:
+        return jsonify({"message": "Direct uploads need object storage; use /api/uploads"}), 501
+    data = request.get_json() or {}
+    upload_type, path = direct_upload_request(data)
+    post = upload_target_post(data)
+    
+    size = storage.verify(path, data['sha256'])
+    if size is None:
+        # Don't leave other content sitting at this content address, unless
+        # posts already use the object there
+        if Media.query.filter_by(path=path).first() is None:
+            storage.delete(path)
+        return jsonify({"message": "Upload missing or checksum mismatch"}), 400
+    
+    add_media_reference(path, data['sha256'], size)
+    return jsonify(attach_upload(post, upload_type, path)), 201
+
 # Get categories
 @api.route('/categories', methods=['GET'])
+@replica_router.read_only
+# Cached until a post write changes the counts
+@response_cache.cached('categories', timeout=0)
 def get_categories():
-    categories = db.session.query(Post.category).distinct().all()
-    return jsonify([cat[0] for cat in categories if cat[0]]), 200
+    stats = CategoryStat.query.filter(CategoryStat.post_count > 0).order_by(CategoryStat.category).all()
+    if request.args.get('counts', '').lower() in ('1', 'true'):
+        return jsonify([stat.to_dict() for stat in stats]), 200
+    return jsonify([stat.category for stat in stats]), 200
+
+# Tags with the number of published posts carrying each
+@api.route('/tags', methods=['GET'])
+@replica_router.read_only
+@response_cache.cached('tags')
+def get_tags():
+    post_count = db.func.count(Post.id).label('post_count')
+    rows = (
+        db.session.query(Tag.name, post_count)
+        .join(post_tag, post_tag.c.tag_id == Tag.id)
+        .join(Post, Post.id == post_tag.c.post_id)
+        .filter(Post.status == 'published')
+        .group_by(Tag.id, Tag.name)
+        .order_by(post_count.desc(), Tag.name)
+        .all()
+    )
+    return jsonify([{'name': name, 'count': count} for name, count in rows]), 200
 
 # Comments endpoints
 @api.route('/posts/<int:post_id>/comments', methods=['GET'])
+@replica_router.read_only
+@response_cache.cached('comments:{post_id}')
 def get_comments(post_id):
-    comments = Comment.query.filter_by(post_id=post_id, parent_id=None).order_by(Comment.created_at.desc()).all()
-    return jsonify([comment.to_dict() for comment in comments]), 200
+    # Load the whole thread with authors in one query and nest it in Python
+    serializer = comment_serializer()
+    rows = (
+        serializer.query()
+        .filter(Comment.post_id == post_id)
+        .order_by(Comment.created_at, Comment.id)
+        .all()
+    )
+    
+    etag = rows_etag('comments', rows, post_id)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    return set_validators(jsonify(Comment.build_tree([serializer(row) for row in rows])), etag), 200
 
 @api.route('/posts/<int:post_id>/comments', methods=['POST'])
 @jwt_required()
@@ -242,6 +658,7 @@ def create_comment(post_id):
     
     db.session.add(new_comment)
     db.session.commit()
+    response_cache.invalidate('comments', f'comments:{post_id}')
     
     return jsonify(new_comment.to_dict()), 201
 
@@ -259,6 +676,7 @@ def update_comment(id):
     comment.content = data.get('content', comment.content)
     
     db.session.commit()
+    response_cache.invalidate('comments', f'comments:{comment.post_id}')
     return jsonify(comment.to_dict()), 200
 
 @api.route('/comments/<int:id>', methods=['DELETE'])
@@ -272,28 +690,54 @@ def delete_comment(id):
     if int(comment.user_id) != int(current_user_id) and not (user and user.is_admin):
         return jsonify({"message": "Permission denied"}), 403
         
+    post_id = comment.post_id
     db.session.delete(comment)
     db.session.commit()
+    response_cache.invalidate('comments', f'comments:{post_id}')
     
     return jsonify({"message": "Comment deleted"}), 200
 
 # User profile endpoints
 @api.route('/users/<int:user_id>', methods=['GET'])
+@replica_router.read_only
+@response_cache.cached('user:{user_id}')
 def get_user_profile(user_id):
+    page = int(request.args.get('page', 1))
+    per_page = requested_per_page()
+    if per_page is None:
+        return jsonify({"message": "per_page must be a positive number"}), 400
+    
     user = User.query.get_or_404(user_id)
-    posts = Post.query.filter_by(user_id=user_id, status='published').order_by(Post.created_at.desc()).all()
+    serializer = post_serializer(Post.SUMMARY_FIELDS)
+    posts = (
+        serializer.query()
+        .filter(Post.user_id == user_id, Post.status == 'published')
+        .order_by(Post.created_at.desc())
+        .paginate(page=page, per_page=per_page, error_out=False)
+    )
+    
+    user_data = user.to_dict()
+    etag = rows_etag('user', posts.items, sorted(user_data.items()), posts.total)
+    response = not_modified(etag)
+    if response is not None:
+        return response
     
-    return jsonify({
-        'user': user.to_dict(),
-        'posts': [post.to_dict() for post in posts],
-        'post_count': len(posts)
-    }), 200
+    return set_validators(jsonify({
+        'user': user_data,
+        'posts': [serializer(row) for row in posts.items],
+        'post_count': posts.total,
+        'pages': posts.pages,
+        'current_page': page,
+        'has_next': posts.has_next,
+        'has_prev': posts.has_prev
+    }), etag), 200
 
 @api.route('/users/profile', methods=['PUT'])
 @jwt_required()
 def update_profile():
     current_user_id = get_jwt_identity()
     user = User.query.get_or_404(current_user_id)
+    old_username = user.username
     
     # Handle both JSON and multipart/form-data requests
     if request.content_type and 'multipart/form-data' in request.content_type:
@@ -306,6 +750,7 @@ def update_profile():
             avatar_file = request.files['avatar']
             avatar_url = save_uploaded_file(avatar_file, 'avatar')
             if avatar_url:
+                release_media(user.avatar_url)
                 user.avatar_url = avatar_url
     else:
         data = request.get_json()
@@ -314,8 +759,26 @@ def update_profile():
         user.bio = data.get('bio', user.bio)
     
     db.session.commit()
+    
+    tags = ['users', f'user:{user.id}']
+    if user.username != old_username:
+        # The author name is embedded in cached posts and comment threads
+        post_ids = [row[0] for row in db.session.query(Post.id).filter_by(user_id=user.id)]
+        thread_ids = [row[0] for row in db.session.query(Comment.post_id).filter_by(user_id=user.id).distinct()]
+        tags += ['posts'] + [f'post:{pid}' for pid in post_ids] + [f'comments:{pid}' for pid in thread_ids]
+    response_cache.invalidate(*tags)
+    
     return jsonify(user.to_dict()), 200
 
+# Password hashing pool metrics for admin
+@api.route('/metrics/password-hashing', methods=['GET'])
+@jwt_required()
+def get_password_hashing_metrics():
+    user = User.query.get(get_jwt_identity())
+    if not user or not user.is_admin:
+        return jsonify({"message": "Admin access required"}), 403
+    return jsonify(password_hasher.stats()), 200
+
 # Dashboard stats for admin
 @api.route('/dashboard/stats', methods=['GET'])
 @jwt_required()
@@ -326,17 +789,38 @@ def get_dashboard_stats():
     if not user or not user.is_admin:
         return jsonify({"message": "Admin access required"}), 403
     
-    total_posts = Post.query.count()
-    total_users = User.query.count()
-    total_comments = Comment.query.count()
-    published_posts = Post.query.filter_by(status='published').count()
-    draft_posts = Post.query.filter_by(status='draft').count()
-    
-    # Recent activity
-    recent_posts = Post.query.order_by(Post.created_at.desc()).limit(5).all()
-    recent_comments = Comment.query.order_by(Comment.created_at.desc()).limit(5).all()
+    stats = response_cache.get_or_set(
+        'dashboard-stats', ['posts', 'comments', 'users'], load_dashboard_stats,
+        timeout=current_app.config.get('DASHBOARD_STATS_TIMEOUT', 30)
+    )
+    return jsonify(stats), 200
+
+def load_dashboard_stats():
+    # All counts in a single round trip
+    count = db.func.count
+    total_posts, published_posts, draft_posts, total_users, total_comments = db.session.query(
+        db.select(count(Post.id)).scalar_subquery(),
+        db.select(count(Post.id)).where(Post.status == 'published').scalar_subquery(),
+        db.select(count(Post.id)).where(Post.status == 'draft').scalar_subquery(),
+        db.select(count(User.id)).scalar_subquery(),
+        db.select(count(Comment.id)).scalar_subquery()
+    ).one()
+    
+    # Recent activity, with authors loaded in the same query
+    recent_posts = (
+        Post.query.options(db.joinedload(Post.author))
+        .order_by(Post.created_at.desc())
+        .limit(5)
+        .all()
+    )
+    recent_comments = (
+        Comment.query.options(db.joinedload(Comment.author))
+        .order_by(Comment.created_at.desc())
+        .limit(5)
+        .all()
+    )
     
-    return jsonify({
+    return {
         'stats': {
             'total_posts': total_posts,
             'total_users': total_users,
@@ -345,5 +829,6 @@ def get_dashboard_stats():
             'draft_posts': draft_posts
         },
         'recent_posts': [post.to_dict() for post in recent_posts],
-        'recent_comments': [comment.to_dict() for comment in recent_comments]
-    }), 200
\ No newline at end of file
+        # Recent activity is a flat list; threads are served by get_comments
+        'recent_comments': [comment.to_dict(replies=[]) for comment in recent_comments]
+    }
@@ -0,0 +1,140 @@
+"""
+Full-text search over posts backed by an SQLite FTS5 index.
+
+The ``post_fts`` virtual table is an external-content index over
+``post.title`` and ``post.content_text``, the post body with its markup
+removed; triggers keep it in sync with every insert, update and delete on
+the ``post`` table.
+"""
+
+import re
+from markupsafe import escape
+from models import db, Post
+
+FTS_TABLE = 'post_fts'
+SNIPPET_TOKENS = 16
+
+# Placeholders snippet() puts around matches; replaced by <mark> after escaping
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+post_fts = db.table(FTS_TABLE, db.column('rowid'), db.column(FTS_TABLE))
+
+_SCHEMA = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, content_text, content='post', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON post BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, content_text)
+        VALUES (new.id, new.title, new.content_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON post BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, content_text)
+        VALUES ('delete', old.id, old.title, old.content_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, content_text ON post BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, content_text)
+        VALUES ('delete', old.id, old.title, old.content_text);
+        INSERT INTO {FTS_TABLE}(rowid, title, content_text)
+        VALUES (new.id, new.title, new.content_text);
+    END
+    """,
+]
+
+_TRIGGERS = [f'{FTS_TABLE}_ai', f'{FTS_TABLE}_ad', f'{FTS_TABLE}_au']
+
+_available = {}
+
+
+def init_search_index():
+    """Create the FTS index and its triggers, backfilling existing posts"""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+
+    with db.engine.begin() as conn:
+        schema = conn.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE name = :name"
+        ), {'name': FTS_TABLE}).scalar()
+        exists = schema is not None and 'content_text' in schema
+        if schema is not None and not exists:
+            # Older index over the raw HTML content: replace it
+            for trigger in _TRIGGERS:
+                conn.execute(db.text(f"DROP TRIGGER IF EXISTS {trigger}"))
+            conn.execute(db.text(f"DROP TABLE {FTS_TABLE}"))
+        for statement in _SCHEMA:
+            conn.execute(db.text(statement))
+        if not exists:
+            conn.execute(db.text(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+            ))
+
+    _available[db.engine.url] = True
+    return True
+
+
+def search_index_available():
+    """True when the current database has a usable FTS index"""
+    engine = db.engine
+    if engine.url not in _available:
+        if engine.dialect.name != 'sqlite':
+            _available[engine.url] = False
+        else:
+            with engine.connect() as conn:
+                _available[engine.url] = conn.execute(db.text(
+                    "SELECT 1 FROM sqlite_master WHERE name = :name"
+                ), {'name': FTS_TABLE}).first() is not None
+    return _available[engine.url]
+
+
+def build_match_expression(term):
+    """Turn free text into an FTS5 query where every word is a prefix match"""
+    words = re.findall(r'\w+', term or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def highlight_snippet(snippet):
+    """HTML for a search snippet: the text escaped, the matches wrapped in <mark>"""
+    if snippet is None:
+        return None
+    return str(escape(snippet)).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def apply_search(query, term, rank=True):
+    """
+    Restrict a Post query to posts matching ``term``.
+
+    Returns ``(query, highlighted)``. When the FTS index is available the
+    query gains a ``snippet`` column (render it with ``highlight_snippet``)
+    and, with ``rank``, is ordered by relevance; otherwise it falls back to
+    a ``LIKE`` filter.
+    """
+    match = build_match_expression(term)
+    if match is None or not search_index_available():
+        query = query.filter(
+            db.or_(
+                Post.title.contains(term),
+                Post.content_text.contains(term)
+            )
+        )
+        return query, False
+
+    fts = db.literal_column(FTS_TABLE)
+    snippet = db.func.snippet(fts, 1, MATCH_START, MATCH_END, '…', SNIPPET_TOKENS)
+    query = (
+        query.join(post_fts, post_fts.c.rowid == Post.id)
+        .filter(fts.op('MATCH')(match))
+        .add_columns(snippet.label('snippet'))
+    )
+    if rank:
+        query = query.order_by(db.func.bm25(fts, 10.0, 1.0))
+    return query, True
@@ -0,0 +1,87 @@
+"""
+Row serializers for list endpoints.
+
+A serializer selects only the columns its fields need and turns each
+result row into a dict, without building ORM objects: no identity map, no
+relationship loading, and tags and authors resolved in the same query. One
+serializer is compiled per field set and reused.
+
+Single objects keep ``to_dict`` on the models; both produce the same output.
+"""
+
+from functools import lru_cache
+from models import db, Post, Comment, User, POST_FIELDS
+
+
+def split_tags(value):
+    return value.split(',') if value else []
+
+
+def author_name(value):
+    return value if value is not None else 'Unknown'
+
+
+def author_column(model):
+    return db.select(User.username).where(User.id == model.user_id).scalar_subquery()
+
+
+# Field name: (SQL expression, converter for the column value); same fields as POST_FIELDS
+POST_COLUMNS = {
+    'id': (Post.id, None),
+    'title': (Post.title, None),
+    'content': (Post.content, None),
+    'excerpt': (Post.excerpt, None),
+    'category': (Post.category, None),
+    'tags': (Post.tags, split_tags),
+    'status': (Post.status, None),
+    'user_id': (Post.user_id, None),
+    'author': (author_column(Post), author_name),
+    'image_url': (Post.image_url, None),
+    'image_variants': (Post.image_variants, None),
+    'video_url': (Post.video_url, None),
+    'views': (Post.views, None),
+    'created_at': (Post.created_at, None),
+    'updated_at': (db.func.coalesce(Post.updated_at, Post.created_at), None)
+}
+assert POST_COLUMNS.keys() == POST_FIELDS.keys()
+
+COMMENT_COLUMNS = {
+    'id': (Comment.id, None),
+    'content': (Comment.content, None),
+    'user_id': (Comment.user_id, None),
+    'post_id': (Comment.post_id, None),
+    'parent_id': (Comment.parent_id, None),
+    'author': (author_column(Comment), author_name),
+    'created_at': (Comment.created_at, None)
+}
+
+
+class RowSerializer:
+    def __init__(self, model, columns, fields, keys=()):
+        self.model = model
+        self.fields = tuple(fields)
+        # Key columns (e.g. for cursors) follow the fields and stay out of the output
+        names = self.fields + tuple(key for key in keys if key not in self.fields)
+        self.columns = [columns[name][0].label(name) for name in names]
+        self.converters = [(name, columns[name][1]) for name in self.fields if columns[name][1]]
+
+    def query(self):
+        """Query selecting this serializer's columns; filter and order it like a model query"""
+        return db.session.query(*self.columns).select_from(self.model)
+
+    def __call__(self, row):
+        item = dict(zip(self.fields, row))
+        for name, convert in self.converters:
+            item[name] = convert(item[name])
+        return item
+
+
+@lru_cache(maxsize=64)
+def post_serializer(fields):
+    # id and created_at are the feed's keyset cursor
+    return RowSerializer(Post, POST_COLUMNS, fields, keys=('id', 'created_at'))
+
+
+@lru_cache(maxsize=1)
+def comment_serializer():
+    return RowSerializer(Comment, COMMENT_COLUMNS, tuple(COMMENT_COLUMNS))
@@ -0,0 +1,230 @@
+"""
+Storage backends for uploaded media.
+
+``storage`` hides where upload files live. Paths are the relative paths
+kept in the database, e.g. ``images/<sha256>.jpg``.
+
+``LocalStorage`` keeps files under UPLOAD_FOLDER and the /uploads route
+sends them. ``S3Storage`` keeps them in an S3-compatible bucket (AWS S3,
+MinIO, ...), so any number of API servers share one media store; /uploads
+redirects to the bucket, and clients can upload straight to it with a
+presigned request so media bytes never pass through the API workers.
+"""
+
+import os
+import base64
+import hashlib
+import mimetypes
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+def content_type(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """Files on this server's disk"""
+
+    direct_uploads = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, path):
+        return os.path.join(self.root, path)
+
+    def exists(self, path):
+        return os.path.isfile(self.local_path(path))
+
+    def put(self, path, source):
+        """Move a finished local file into storage"""
+        target = self.local_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(source, target)
+
+    def delete(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except OSError:
+            pass
+
+    def delete_prefix(self, prefix):
+        folder, start = prefix.rsplit('/', 1)
+        folder = self.local_path(folder)
+        if not os.path.isdir(folder):
+            return
+        for name in os.listdir(folder):
+            if name.startswith(start):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError:
+                    pass
+
+    @contextmanager
+    def open_local(self, path):
+        """A local filename holding the file's content"""
+        yield self.local_path(path)
+
+    def url(self, path):
+        """External URL of a file, or None when the /uploads route sends it"""
+        return None
+
+    def presigned_upload(self, path, checksum, size):
+        return None
+
+    def verify(self, path, checksum):
+        return None
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket"""
+
+    direct_uploads = True
+
+    def __init__(self, bucket, prefix='', public_url=None, expiry=3600, cache_control=None, **client_options):
+        # SigV4 signs the checksum header into presigned uploads
+        self.client = boto3.client('s3', config=BotoConfig(signature_version='s3v4'), **client_options)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url
+        self.expiry = expiry
+        # Every stored name is content-addressed, so objects never change
+        self.cache_control = cache_control
+
+    def key(self, path):
+        return self.prefix + path
+
+    def object_headers(self, path):
+        headers = {'ContentType': content_type(path)}
+        if self.cache_control:
+            headers['CacheControl'] = self.cache_control
+        return headers
+
+    def exists(self, path):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def put(self, path, source):
+        self.client.upload_file(source, self.bucket, self.key(path), ExtraArgs=self.object_headers(path))
+        os.remove(source)
+
+    def delete(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+
+    def delete_prefix(self, prefix):
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.key(prefix))
+        for page in pages:
+            keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys})
+
+    @contextmanager
+    def open_local(self, path):
+        fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.key(path), temp_path)
+            yield temp_path
+        finally:
+            os.remove(temp_path)
+
+    def url(self, path):
+        if self.public_url:
+            return f"{self.public_url.rstrip('/')}/{self.key(path)}"
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self.key(path)},
+            ExpiresIn=self.expiry
+        )
+
+    def presigned_upload(self, path, checksum, size):
+        """
+        A presigned PUT for uploading a file straight to the bucket. The
+        SHA-256 and length are part of the signature, so S3 rejects any other
+        content; ``verify`` checks again for stores that don't.
+        """
+        headers = {
+            'Content-Type': content_type(path),
+            'x-amz-checksum-sha256': base64.b64encode(bytes.fromhex(checksum)).decode()
+        }
+        params = {
+            'Bucket': self.bucket,
+            'Key': self.key(path),
+            'ContentLength': size,
+            'ChecksumSHA256': headers['x-amz-checksum-sha256'],
+            **self.object_headers(path)
+        }
+        if self.cache_control:
+            headers['Cache-Control'] = self.cache_control
+        url = self.client.generate_presigned_url('put_object', Params=params, ExpiresIn=self.expiry)
+        return {'method': 'PUT', 'url': url, 'headers': headers, 'expires_in': self.expiry}
+
+    def verify(self, path, checksum):
+        """Size of a stored object whose content has the given SHA-256, else None"""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(path), ChecksumMode='ENABLED')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            # e.g. access denied or throttling: not proof the upload is missing
+            raise
+        stored = head.get('ChecksumSHA256')
+        if stored and '-' not in stored:
+            matches = base64.b64decode(stored).hex() == checksum
+        else:
+            # The store kept no whole-object checksum; hash the object instead
+            digest = hashlib.sha256()
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(path))['Body']
+            for block in body.iter_chunks(64 * 1024):
+                digest.update(block)
+            matches = digest.hexdigest() == checksum
+        return head['ContentLength'] if matches else None
+
+
+class Storage:
+    """Storage backend chosen by STORAGE_BACKEND; backend methods are available on it directly"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('STORAGE_BACKEND', 'local') == 's3':
+            if boto3 is None:
+                raise RuntimeError("STORAGE_BACKEND 's3' requires the boto3 package")
+            max_age = app.config.get('MEDIA_MAX_AGE')
+            self.backend = S3Storage(
+                app.config['S3_BUCKET'],
+                prefix=app.config.get('S3_KEY_PREFIX', ''),
+                public_url=app.config.get('S3_PUBLIC_URL'),
+                expiry=app.config.get('PRESIGNED_URL_EXPIRY', 3600),
+                cache_control=f'public, max-age={max_age}, immutable' if max_age else None,
+                endpoint_url=app.config.get('S3_ENDPOINT_URL'),
+                region_name=app.config.get('S3_REGION')
+            )
+        else:
+            self.backend = LocalStorage(app.config['UPLOAD_FOLDER'])
+        app.extensions['storage'] = self
+
+    def __getattr__(self, name):
+        if self.backend is None:
+            raise RuntimeError('storage is not initialized')
+        return getattr(self.backend, name)
+
+
+storage = Storage()
@@ -0,0 +1,113 @@
+"""
+Query plans of the read endpoints.
+
+Seeds an SQLite database, runs ANALYZE, calls each endpoint and checks
+with EXPLAIN QUERY PLAN that none of the queries it ran reads the whole
+post or comment table.
+
+Run from the backend directory (pytest is in requirements-dev.txt):
+python -m pytest -q test_query_plans.py
+"""
+
+import os
+import re
+import pytest
+
+# SCAN post / SCAN TABLE post (older SQLite), but not the post_fts index
+FULL_SCAN = re.compile(r'\bSCAN (TABLE )?(post|comment)\b')
+
+ENDPOINTS = [
+    '/api/posts',
+    '/api/posts?page=3',
+    '/api/posts?view=summary',
+    '/api/posts?category=Tech',
+    '/api/posts?tag=python',
+    '/api/posts?search=lorem',
+    '/api/posts?after=',
+    '/api/posts?after=&include_total=1',
+    '/api/posts?after=&category=Tech',
+    '/api/posts?after=&search=lorem',
+    '/api/posts/7',
+    '/api/posts/7/comments',
+    '/api/users/3',
+]
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # Config reads the environment on import
+    os.environ['DATABASE_URL'] = f"sqlite:///{tmp_path_factory.mktemp('db') / 'plans.db'}"
+    os.environ['CACHE_TYPE'] = 'none'
+    os.environ['PASSWORD_HASH_WORKERS'] = '0'
+    from app import app, init_database
+    from models import db, User, Post, Comment, Tag, post_tag
+
+    init_database()
+    with app.app_context():
+        categories = ['Tech', 'Life', 'Travel', 'General']
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'user{i}', 'email': f'user{i}@example.com', 'password': 'x'}
+            for i in range(1, 51)
+        ])
+        db.session.execute(Post.__table__.insert(), [
+            {
+                'title': f'Post {i}',
+                'content': f'<p>lorem ipsum {i}</p>',
+                'content_text': f'lorem ipsum {i}',
+                'category': categories[i % len(categories)],
+                'tags': 'python,flask' if i % 5 == 0 else 'notes',
+                'status': 'draft' if i % 10 == 0 else 'published',
+                'user_id': i % 50 + 1,
+                'views': i,
+            }
+            for i in range(1, 2001)
+        ])
+        db.session.execute(Tag.__table__.insert(), [{'name': name} for name in ('python', 'flask', 'notes')])
+        tag_ids = dict(db.session.query(Tag.name, Tag.id).all())
+        db.session.execute(post_tag.insert(), [
+            {'post_id': i, 'tag_id': tag_ids[name]}
+            for i in range(1, 2001)
+            for name in (('python', 'flask') if i % 5 == 0 else ('notes',))
+        ])
+        db.session.execute(Comment.__table__.insert(), [
+            {'content': f'comment {i}', 'user_id': i % 50 + 1, 'post_id': i % 2000 + 1}
+            for i in range(1, 8001)
+        ])
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+
+    with app.app_context():
+        yield app, db
+
+
+def query_plans(app, db, url):
+    """EXPLAIN QUERY PLAN rows of every SELECT a request runs"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    db.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = app.test_client().get(url)
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', record)
+    assert response.status_code == 200, (url, response.status_code)
+    assert statements, url
+
+    plans = []
+    with db.engine.connect() as conn:
+        for statement, parameters in statements:
+            rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+
+@pytest.mark.parametrize('url', ENDPOINTS)
+def test_no_full_table_scan(client, url):
+    app, db = client
+    for statement, plan in query_plans(app, db, url):
+        scans = [step for step in plan if FULL_SCAN.search(step)]
+        assert not scans, f'{url} scans a table:\n{statement}\n' + '\n'.join(plan)
@@ -0,0 +1,112 @@
+"""
+Buffered view counting for posts.
+
+Reads record views in memory; a background thread writes the accumulated
+deltas back to ``post.views`` in a single batched UPDATE, either every
+``VIEW_COUNT_FLUSH_INTERVAL`` seconds or as soon as
+``VIEW_COUNT_FLUSH_THRESHOLD`` views are pending.
+"""
+
+import atexit
+import threading
+from models import db, Post
+from cache import response_cache
+
+
+class ViewCounter:
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 5
+        self.threshold = 100
+        self._pending = {}
+        self._flushing = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('VIEW_COUNT_FLUSH_INTERVAL', self.interval)
+        self.threshold = app.config.get('VIEW_COUNT_FLUSH_THRESHOLD', self.threshold)
+        app.extensions['view_counter'] = self
+        atexit.register(self._flush_on_exit)
+
+    def record(self, post_id):
+        """Count one view of a post without touching the database"""
+        with self._lock:
+            self._pending[post_id] = self._pending.get(post_id, 0) + 1
+            self._total += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='view-counter', daemon=True
+                )
+                self._thread.start()
+            if self._total >= self.threshold:
+                self._wakeup.set()
+
+    def pending(self, post_id):
+        """Views recorded for a post that are not yet in the database"""
+        with self._lock:
+            return self._pending.get(post_id, 0) + self._flushing.get(post_id, 0)
+
+    def flush(self):
+        """Write all pending views in one batched UPDATE; needs an app context"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            self._total = 0
+        if not batch:
+            return 0
+
+        post = Post.__table__
+        stmt = (
+            post.update()
+            .where(post.c.id == db.bindparam('post_id'))
+            # Keep updated_at untouched: a view is not an edit
+            .values(
+                views=db.func.coalesce(post.c.views, 0) + db.bindparam('delta'),
+                updated_at=post.c.updated_at
+            )
+        )
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(stmt, [
+                    {'post_id': post_id, 'delta': delta}
+                    for post_id, delta in batch.items()
+                ])
+        except Exception:
+            # Put the views back so the next flush retries them
+            with self._lock:
+                self._flushing = {}
+                for post_id, delta in batch.items():
+                    self._pending[post_id] = self._pending.get(post_id, 0) + delta
+                    self._total += delta
+            raise
+        finally:
+            with self._lock:
+                self._flushing = {}
+        response_cache.invalidate(*(f'post:{post_id}' for post_id in batch))
+        return len(batch)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception('Failed to flush view counts')
+
+    def _flush_on_exit(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to flush view counts on exit')
+
+
+view_counter = ViewCounter()
@@ -30,7 +30,8 @@ const Home = () => {
             const params = {
                 page: currentPage,
                 per_page: 6,
-                status: 'published'
+                status: 'published',
+                view: 'summary'
             };
             
             if (searchTerm) params.search = searchTerm;
@@ -266,8 +267,9 @@ const Home = () => {
                         <div style={{ height: '200px', overflow: 'hidden', backgroundColor: '#f3f4f6' }}>
                             {post.image_url ? (
                                 <img 
-                                    src={`http://localhost:5000/uploads/${post.image_url}`} 
+                                    src={`http://localhost:5000/uploads/${post.image_url}?w=640`} 
                                     alt={post.title}
+                                    loading="lazy"
                                     style={{ width: '100%', height: '100%', objectFit: 'cover', transition: 'transform 0.3s ease' }}
                                     onMouseOver={(e) => e.target.style.transform = 'scale(1.1)'}
                                     onMouseOut={(e) => e.target.style.transform = 'scale(1)'}
@@ -329,7 +331,7 @@ const Home = () => {
                             <div 
                                 style={{ color: 'var(--text-secondary)', lineHeight: '1.6', marginBottom: '1rem', flex: 1 }}
                                 dangerouslySetInnerHTML={{ 
-                                    __html: renderPostContent(post.content.substring(0, 150) + '...') 
+                                    __html: renderPostContent((post.excerpt ?? post.content).substring(0, 150) + '...') 
                                 }}
                             />
 